@@ -1,21 +1,91 @@
+import axios from "axios";
 import Event from "../models/Event.js";
+import EventLog from "../models/EventLog.js";
 import { getRedis } from "../config/redis.js";
 
+// The recommender reads this list (newest first) instead of calling GET /api/events/:id
+const EVENT_BUFFER_SIZE = 20;
+
+// Seed (history, oldest last) only while the buffer is missing, and push the
+// event unless a concurrent first event already seeded it: one atomic step,
+// so racing first events neither seed twice nor list an event twice.
+const PUSH_EVENT_SCRIPT = `
+if redis.call("EXISTS", KEYS[1]) == 0 then
+  for i = 2, #ARGV - 1 do redis.call("RPUSH", KEYS[1], ARGV[i]) end
+elseif redis.call("LPOS", KEYS[1], ARGV[1]) then
+  return 0
+end
+redis.call("LPUSH", KEYS[1], ARGV[1])
+redis.call("LTRIM", KEYS[1], 0, ${EVENT_BUFFER_SIZE - 1})
+redis.call("EXPIRE", KEYS[1], ARGV[#ARGV])
+return 1
+`;
+
+// Push an event onto the Redis `user_events:{id}` buffer (last 20, session TTL).
+// A missing buffer is first seeded from the stored history, so the recommender
+// never sees fewer events than GET /api/events/:id would return.
+export const bufferRecentEvent = async ({ user_id, event_type, product_id, ts }) => {
+  let client;
+  try {
+    client = getRedis();
+  } catch (_) {
+    return;
+  }
+  try {
+    const key = `user_events:${user_id}`;
+    const entry = (ev) =>
+      JSON.stringify({ product_id: ev.product_id, event_type: ev.event_type, ts: ev.createdAt });
+    let older = [];
+    if (!(await client.exists(key))) {
+      older = await EventLog.find({ user_id, createdAt: { $lt: ts } })
+        .sort({ createdAt: -1 })
+        .limit(EVENT_BUFFER_SIZE - 1)
+        .lean();
+    }
+    await client.eval(PUSH_EVENT_SCRIPT, {
+      keys: [key],
+      arguments: [
+        entry({ product_id, event_type, createdAt: ts }),
+        ...older.map(entry),
+        String(Number(process.env.GUEST_SESSION_TTL || 86400)),
+      ],
+    });
+  } catch (e) {
+    console.warn("redis buffer push failed", e.message);
+  }
+};
+
+// Fold the event into the recommender's incremental user profile.
+// Fire-and-forget: event logging never waits on (or fails with) the recommender.
+// A failed update drops the profile instead of leaving it short of one event:
+// the recommender uses the event history until the next event re-seeds it.
+export const updateRecommenderProfile = ({ user_id, event_type, product_id, ts }) => {
+  const base = process.env.RECOMMENDER_API_URL;
+  if (!base) return;
+  axios
+    .post(
+      `${base.replace(/\/$/, "")}/profile/event`,
+      { user_id, event_type, product_id, ts: ts ? new Date(ts).getTime() / 1000 : undefined },
+      { timeout: 2000 }
+    )
+    .catch(async (e) => {
+      console.warn("recommender profile update failed", e.message);
+      try {
+        await getRedis().del(`user_profile:${user_id}`);
+      } catch (_) {
+        // no Redis: the profile expires on its own
+      }
+    });
+};
+
 export const logEvent = async (req, res, next) => {
   try {
     const { event_type, product_id, metadata } = req.body;
     const user_id = req.sessionId || req.body.user_id;
     const ev = await Event.create({ user_id, event_type, product_id, metadata });
     // push to redis event buffer for quick access (store last 20)
-    try {
-      const client = getRedis();
-      if (client) {
-        const key = `user_events:${user_id}`;
-        await client.lPush(key, JSON.stringify({ product_id, event_type, ts: ev.createdAt }));
-        await client.lTrim(key, 0, 19);
-        await client.expire(key, Number(process.env.GUEST_SESSION_TTL || 86400));
-      }
-    } catch(e) { console.warn("redis buffer push failed", e); }
+    await bufferRecentEvent({ user_id, event_type, product_id, ts: ev.createdAt });
+    updateRecommenderProfile({ user_id, event_type, product_id, ts: ev.createdAt });
     res.json({ ok: true, event: ev });
   } catch (err) { next(err); }
 };
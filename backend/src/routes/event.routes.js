@@ -3,6 +3,7 @@ import EventLog from "../models/EventLog.js";
 import sessionGuard from "../middlewares/sessionGuard.js";
 // Optional: legacy Event model used elsewhere; keep for future reads if needed
 import Event from "../models/Event.js";
+import { bufferRecentEvent, updateRecommenderProfile } from "../controllers/eventController.js";
 
 const router = express.Router();
 
@@ -18,7 +19,9 @@ router.post("/log", sessionGuard(false), async (req, res) => {
     }
 
     // Write to EventLog (primary store used by recommender)
-    await EventLog.create({ user_id: sid, event_type, product_id });
+    const log = await EventLog.create({ user_id: sid, event_type, product_id });
+    await bufferRecentEvent({ user_id: sid, event_type, product_id, ts: log.createdAt });
+    updateRecommenderProfile({ user_id: sid, event_type, product_id, ts: log.createdAt });
     // Also write to Event (legacy store) to keep other controllers functional
     try {
       await Event.create({ user_id: sid, event_type, product_id });
@@ -41,7 +44,9 @@ router.post("/", sessionGuard(false), async (req, res) => {
       return res.status(400).json({ error: "Missing fields" });
     }
 
-    await EventLog.create({ user_id: sid, event_type, product_id });
+    const log = await EventLog.create({ user_id: sid, event_type, product_id });
+    await bufferRecentEvent({ user_id: sid, event_type, product_id, ts: log.createdAt });
+    updateRecommenderProfile({ user_id: sid, event_type, product_id, ts: log.createdAt });
     try {
       await Event.create({ user_id: sid, event_type, product_id });
     } catch (_) {}
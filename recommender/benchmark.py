@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Latency / throughput / memory benchmark for the recommender on synthetic catalogs.
+
+    python benchmark.py --sizes 2000,20000,100000,1000000 --queries 2000 --json bench.json
+
+For every catalog size this generates a product CSV, runs a full versioned
+build (build_embeddings.build_version), loads the snapshot and measures:
+
+  build           wall time of the full build
+  vector_search   one FAISS query per call (random unit vectors)
+  user_vector     compute_user_vector_from_events on 1-20 event sessions
+  recommend_miss  GET /recommend through the ASGI app, unique users (cache misses)
+  recommend_hit   the same requests again (served from the result cache)
+  recommend_cold  users without any activity (cold-start ranking)
+
+reporting p50 / p95 / p99 latency in ms, QPS and process RSS. Everything runs
+in one process against a temporary directory: Redis is replaced by fakeredis
+(pip install fakeredis) and the Node events API by a local stub transport,
+so results only depend on this service. Embeddings come from a seeded
+synthetic encoder unless --real-encoder is given (MiniLM, slow on CPU).
+Index settings (INDEX_TYPE, IVF_NPROBE, EMBEDDINGS_DTYPE, ...) are read from
+the environment as usual.
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import asyncio
+import argparse
+import resource
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+CATEGORIES = ["Clothing", "Footwear", "Watches", "Computers", "Beauty and Personal Care",
+              "Kitchen & Dining", "Mobiles & Accessories", "Bags, Wallets & Belts"]
+EVENT_TYPES = ["view", "view", "view", "click", "click", "add_to_cart", "purchase"]
+N_TOPICS = 64
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="2000,20000,100000",
+                        help="comma-separated catalog sizes (default: 2000,20000,100000)")
+    parser.add_argument("--queries", type=int, default=1000, help="measured calls per stage")
+    parser.add_argument("--concurrency", type=int, default=16, help="in-flight /recommend requests")
+    parser.add_argument("--dim", type=int, default=384, help="synthetic embedding dimension")
+    parser.add_argument("--node-latency-ms", type=float, default=0.0, help="simulated Node events API latency")
+    parser.add_argument("--real-encoder", action="store_true", help="encode with MiniLM instead of synthetic vectors")
+    parser.add_argument("--workdir", default=None, help="keep artifacts here instead of a temp dir")
+    parser.add_argument("--json", default=None, help="also write results to this file")
+    return parser.parse_args()
+
+
+def configure_env(workdir: str):
+    """Point every artifact path at `workdir`; must run before the service modules are imported."""
+    os.environ.update(
+        PRODUCTS_CSV=os.path.join(workdir, "products.csv"),
+        ARTIFACTS_DIR=os.path.join(workdir, "artifacts"),
+        EMBEDDINGS_PATH=os.path.join(workdir, "embeddings.npy"),
+        PRODUCT_IDS_PATH=os.path.join(workdir, "product_ids.json"),
+        FAISS_INDEX_PATH=os.path.join(workdir, "faiss_index.bin"),
+        CATALOG_SNAPSHOT_PATH=os.path.join(workdir, "catalog.pkl"),
+        INDEX_REPORT_PATH=os.path.join(workdir, "index_report.json"),
+        REDIS_URL="redis://benchmark/0",
+        OPENAI_API_KEY="",
+        KEEP_VERSIONS="1",
+    )
+
+
+def use_fake_redis():
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("benchmark.py needs fakeredis: pip install fakeredis")
+    import redis
+    server = fakeredis.FakeServer()
+    redis.Redis.from_url = classmethod(lambda cls, url, **kw: fakeredis.FakeRedis(server=server, **kw))
+    return server
+
+
+class SyntheticEncoder:
+    """Stands in for SentenceTransformer: a seeded vector per text, drawn
+    around one of N_TOPICS centres so the catalog has cluster structure."""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.centres = np.random.default_rng(0).standard_normal((N_TOPICS, dim)).astype("float32")
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, batch_size=64, show_progress_bar=False, convert_to_numpy=True):
+        out = np.empty((len(texts), self.dim), dtype="float32")
+        for i, text in enumerate(texts):
+            h = zlib.crc32(text.encode("utf-8"))
+            noise = np.random.default_rng(h).standard_normal(self.dim, dtype="float32")
+            out[i] = self.centres[h % N_TOPICS] + 0.6 * noise
+        return out
+
+
+def write_catalog(path: str, n: int):
+    rng = np.random.default_rng(n)
+    df = pd.DataFrame({
+        "product_id": [f"B{i:07d}" for i in range(n)],
+        "title": [f"Product {i}" for i in range(n)],
+        "description": [f"Synthetic item {i} for benchmarking" for i in range(n)],
+        "brand": [f"Brand{i % 97}" for i in range(n)],
+        "price": rng.uniform(99, 20000, n).round(2),
+        "normalized_top_category": [CATEGORIES[i % len(CATEGORIES)] for i in range(n)],
+    })
+    df.to_csv(path, index=False)
+    return df
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def summarize(name: str, latencies_s, wall_s: float) -> dict:
+    ms = np.asarray(latencies_s) * 1000.0
+    return {
+        "stage": name,
+        "n": int(len(ms)),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "qps": len(ms) / wall_s if wall_s > 0 else float("inf"),
+        "rss_mb": rss_mb(),
+    }
+
+
+def time_calls(name: str, fn, args_list) -> dict:
+    latencies = []
+    start = time.perf_counter()
+    for args in args_list:
+        t0 = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - t0)
+    return summarize(name, latencies, time.perf_counter() - start)
+
+
+def random_sessions(product_ids, n_sessions: int, rng):
+    sessions = []
+    for _ in range(n_sessions):
+        picks = rng.choice(len(product_ids), rng.integers(1, 21))
+        sessions.append([
+            {"product_id": product_ids[i], "event_type": EVENT_TYPES[rng.integers(len(EVENT_TYPES))]}
+            for i in picks
+        ])
+    return sessions
+
+
+async def bench_recommend(main, sessions: dict, paths, concurrency: int, node_latency_ms: float):
+    """(stage, [(user_id, params)]) lists through the ASGI app with a stub Node backend."""
+    import httpx
+
+    async def node_stub(request):
+        if node_latency_ms:
+            await asyncio.sleep(node_latency_ms / 1000.0)
+        user_id = request.url.path.rsplit("/", 1)[1]
+        return httpx.Response(200, json={"recent_events": sessions.get(user_id, [])})
+
+    results = []
+    async with main.lifespan(main.app):
+        await main.node_client.aclose()
+        main.node_client = httpx.AsyncClient(base_url="http://node-stub", transport=httpx.MockTransport(node_stub))
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            sem = asyncio.Semaphore(concurrency)
+
+            async def one(params, latencies):
+                async with sem:
+                    t0 = time.perf_counter()
+                    resp = await client.get("/recommend", params=params)
+                    latencies.append(time.perf_counter() - t0)
+                    resp.raise_for_status()
+
+            for stage, requests in paths:
+                latencies = []
+                start = time.perf_counter()
+                await asyncio.gather(*(one(params, latencies) for params in requests))
+                results.append(summarize(stage, latencies, time.perf_counter() - start))
+    return results
+
+
+def fake_server_flush(server):
+    import fakeredis
+    fakeredis.FakeRedis(server=server).flushall()
+
+
+def run_size(n: int, args, fake_server) -> list:
+    fake_server_flush(fake_server)
+    write_catalog(os.environ["PRODUCTS_CSV"], n)
+    # Imported only now: main loads a snapshot (and so the catalog) at import
+    import build_embeddings
+    import model_snapshot
+    import main
+    rng = np.random.default_rng(42)
+    rows = []
+
+    t0 = time.perf_counter()
+    build_embeddings.build_version(model_snapshot.ARTIFACTS_DIR, full=True)
+    rows.append({"stage": "build", "n": 1, "wall_s": time.perf_counter() - t0,
+                 "rss_mb": rss_mb(), "max_rss_mb": max_rss_mb()})
+
+    main.reload_snapshot_if_changed()
+    snap = main.SNAPSHOT
+    d = snap.index.d
+
+    queries = rng.standard_normal((args.queries, d)).astype("float32")
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    rows.append(time_calls("vector_search", lambda q: main.vector_search(snap, q, top_k=50),
+                           [(queries[i:i + 1],) for i in range(args.queries)]))
+
+    sessions = random_sessions(snap.product_ids, args.queries, rng)
+    rows.append(time_calls("user_vector", lambda ev: main.compute_user_vector_from_events(snap, ev),
+                           [(ev,) for ev in sessions]))
+
+    users = {f"bench-{n}-{i}": ev for i, ev in enumerate(sessions)}
+    warm = [{"user_id": u, "k": 10} for u in users]
+    cold = [{"user_id": f"cold-{n}-{i}", "k": 10,
+             "min_price": float(rng.uniform(99, 5000)), "max_price": 20000.0} for i in range(args.queries)]
+    rows.extend(asyncio.run(bench_recommend(
+        main, users,
+        [("recommend_miss", warm), ("recommend_hit", warm), ("recommend_cold", cold)],
+        args.concurrency, args.node_latency_ms,
+    )))
+    for row in rows:
+        row["catalog"] = n
+    return rows
+
+
+def print_rows(rows):
+    print(f"{'catalog':>9} {'stage':<16} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'qps':>10} {'rss MB':>9}")
+    for r in rows:
+        if r["stage"] == "build":
+            print(f"{r['catalog']:>9} {'build':<16} {'wall ' + format(r['wall_s'], '.1f') + ' s':>29}"
+                  f" {'':>10} {r['rss_mb']:>9.0f}  (max {r['max_rss_mb']:.0f})")
+            continue
+        print(f"{r['catalog']:>9} {r['stage']:<16} {r['p50_ms']:>9.3f} {r['p95_ms']:>9.3f} {r['p99_ms']:>9.3f}"
+              f" {r['qps']:>10.0f} {r['rss_mb']:>9.0f}")
+
+
+def main_cli():
+    args = parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="recommender-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    configure_env(workdir)
+    fake_server = use_fake_redis()
+
+    import utils
+    if not args.real_encoder:
+        utils._models[utils.MODEL_NAME] = SyntheticEncoder(args.dim)
+
+    config = {name: os.getenv(name) for name in ("INDEX_TYPE", "IVF_NPROBE", "HNSW_EF_SEARCH", "EMBEDDINGS_DTYPE")}
+    print("Benchmark config:", json.dumps({**config, "workdir": workdir, "queries": args.queries,
+                                           "concurrency": args.concurrency, "real_encoder": args.real_encoder}))
+
+    rows = []
+    for n in (int(s) for s in args.sizes.split(",") if s.strip()):
+        print(f"\n=== catalog size {n} ===")
+        rows.extend(run_size(n, args, fake_server))
+
+    print()
+    print_rows(rows)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": config, "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
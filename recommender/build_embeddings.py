@@ -1,38 +1,261 @@
 #!/usr/bin/env python3
 import os
+import sys
 import json
+import shutil
+import hashlib
 import numpy as np
 import faiss
-from utils import load_products, compute_embeddings, save_embeddings
+from utils import (
+    EMBED_CHUNK_SIZE, EMBEDDINGS_DTYPE, load_products, compute_embeddings, save_product_ids,
+    save_catalog_snapshot, save_quantized_embeddings,
+)
+from vector_index import (
+    INDEX_SHARDS, INDEX_TYPE, NEIGHBORS_N, create_index, neighbor_table, quantization_report, recall_report,
+    shard_assignment, supports_remove, write_report,
+)
+from model_snapshot import (
+    ARTIFACTS_DIR, LEGACY_VERSION, artifact_paths, build_catalog_arrays, current_version, new_version_dir,
+    publish_version, shard_paths,
+)
 from dotenv import load_dotenv
 load_dotenv()
 
-EMBEDDINGS_PATH = os.getenv("EMBEDDINGS_PATH", "./embeddings.npy")
-FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "./faiss_index.bin")
-PRODUCT_IDS_PATH = os.getenv("PRODUCT_IDS_PATH", "./product_ids.json")
+# Reuse vectors of unchanged products from the previous build (set 0 to always re-encode)
+INCREMENTAL_BUILD = os.getenv("INCREMENTAL_BUILD", "1") == "1"
+
+def product_texts(df):
+    return (df['title'].fillna('') + '. ' + df['description'].fillna('') + '. Brand: ' + df['brand'].fillna('')).tolist()
+
+def text_fingerprints(texts):
+    return [hashlib.sha1(t.encode("utf-8")).hexdigest()[:16] for t in texts]
+
+def load_previous_build(paths):
+    """Artifacts of a previous build that can seed an incremental one, or None."""
+    needed = ("embeddings", "product_ids", "faiss_index", "faiss_ids", "build_state")
+    if not all(os.path.exists(paths[name]) for name in needed):
+        return None
+    with open(paths["build_state"], "r") as f:
+        state = json.load(f)
+    with open(paths["product_ids"], "r") as f:
+        product_ids = json.load(f)
+    return {
+        "index_type": state.get("index_type"),
+        "fingerprints": state.get("fingerprints", []),
+        "product_ids": product_ids,
+        # Mapped: a build writes embeddings to a temp file and os.replace()s it,
+        # so the previous file stays intact while reused rows are copied out
+        "embeddings": np.load(paths["embeddings"], mmap_mode="r"),
+        # Fully read (8 bytes per row): saved over in place by the build
+        "faiss_ids": np.load(paths["faiss_ids"]),
+        "index": faiss.read_index(paths["faiss_index"]),
+    }
+
+def plan_incremental(product_ids, fingerprints, prev):
+    """
+    Match the new catalog against the previous build. Returns the row in the
+    previous embeddings to copy from (-1 = encode), the index id for every
+    row, and the previous ids that must be removed from the index (deleted
+    or changed products).
+    """
+    prev_row = {pid: i for i, pid in enumerate(prev["product_ids"])}
+    prev_ids = prev["faiss_ids"]
+    next_id = int(prev_ids.max()) + 1 if len(prev_ids) else 0
+
+    reuse_from = np.full(len(product_ids), -1, dtype="int64")
+    faiss_ids = np.empty(len(product_ids), dtype="int64")
+    used = set()
+    for i, (pid, fp) in enumerate(zip(product_ids, fingerprints)):
+        j = prev_row.get(pid)
+        if j is not None and j not in used:
+            used.add(j)
+            faiss_ids[i] = prev_ids[j]
+            if j < len(prev["fingerprints"]) and prev["fingerprints"][j] == fp:
+                reuse_from[i] = j
+        else:
+            faiss_ids[i] = next_id
+            next_id += 1
+
+    unchanged = set(reuse_from[reuse_from >= 0].tolist())
+    stale = [int(prev_ids[j]) for j in range(len(prev_ids)) if j not in unchanged]
+    return reuse_from, faiss_ids, np.asarray(stale, dtype="int64")
+
+def build_shards(embeddings, faiss_ids, product_ids, df, shards_dir, n_shards):
+    """
+    Partition the catalog into `n_shards` by product id hash and write, per
+    shard, an index over its rows plus their index ids and catalog filter
+    columns (for shard_server.py). Shard indexes are rebuilt on every build.
+    Returns the row count per shard.
+    """
+    in_lookup, prices, category_codes, category_vocab = build_catalog_arrays(df, product_ids)
+    vocab = np.array(sorted(category_vocab, key=category_vocab.get), dtype=str)
+    assignment = shard_assignment(product_ids, n_shards)
+    counts = []
+    for shard in range(n_shards):
+        rows = np.flatnonzero(assignment == shard)
+        sp = shard_paths(shards_dir, shard)
+        os.makedirs(sp["dir"], exist_ok=True)
+        if len(rows):
+            index_tmp = sp["faiss_index"] + ".tmp"
+            faiss.write_index(create_index(embeddings[rows], INDEX_TYPE), index_tmp)
+            os.replace(index_tmp, sp["faiss_index"])
+        elif os.path.exists(sp["faiss_index"]):
+            os.remove(sp["faiss_index"])
+        columns_tmp = sp["columns"] + ".tmp.npz"
+        np.savez(columns_tmp, ids=faiss_ids[rows], in_lookup=in_lookup[rows], prices=prices[rows],
+                 category_codes=category_codes[rows], categories=vocab)
+        os.replace(columns_tmp, sp["columns"])
+        counts.append(int(len(rows)))
+
+    with open(shard_paths(shards_dir, 0)["manifest"], "w") as f:
+        json.dump({"shards": n_shards, "rows": counts, "index_type": INDEX_TYPE}, f)
+    return counts
+
+def build(paths=None, previous_paths=None, full=False):
+    """Build all artifacts into `paths` (see model_snapshot.artifact_paths);
+    defaults to the legacy EMBEDDINGS_PATH / FAISS_INDEX_PATH / ... locations.
+
+    Unless `full`, products whose text fingerprint matches the build at
+    `previous_paths` keep their vectors and only new/changed products are
+    encoded; the previous index is then updated in place with remove_ids /
+    add_with_ids instead of being rebuilt."""
+    paths = paths or artifact_paths()
 
-def build():
     print("Loading products...")
     df = load_products()
-    texts = (df['title'].fillna('') + '. ' + df['description'].fillna('') + '. Brand: ' + df['brand'].fillna('')).tolist()
+    texts = product_texts(df)
     product_ids = df['product_id'].astype(str).tolist()
+    fingerprints = text_fingerprints(texts)
+
+    prev = None
+    if INCREMENTAL_BUILD and not full:
+        prev = load_previous_build(previous_paths or paths)
+        if prev is not None and prev["index_type"] != INDEX_TYPE:
+            print("Index type changed, doing a full build")
+            prev = None
 
-    print(f"Computing embeddings for {len(texts)} products with MiniLM...")
-    embeddings = compute_embeddings(texts)
-
-    print("Saving embeddings and ids...")
-    save_embeddings(embeddings, product_ids, EMBEDDINGS_PATH, PRODUCT_IDS_PATH)
-
-    # Build FAISS index (IndexFlatIP for cosine if we normalize)
-    print("Building FAISS index (IndexFlatIP)...")
-    d = embeddings.shape[1]
-    index = faiss.IndexFlatIP(d)
-    # normalize embeddings to unit length for cosine similarity with inner product
-    faiss.normalize_L2(embeddings)
-    index.add(embeddings.astype('float32'))
-    faiss.write_index(index, FAISS_INDEX_PATH)
-    print("FAISS index saved to:", FAISS_INDEX_PATH)
+    if prev is None:
+        reuse_from = np.full(len(product_ids), -1, dtype="int64")
+        faiss_ids = np.arange(len(product_ids), dtype="int64")
+        stale = np.zeros(0, dtype="int64")
+    else:
+        reuse_from, faiss_ids, stale = plan_incremental(product_ids, fingerprints, prev)
+
+    to_encode = np.flatnonzero(reuse_from < 0)
+    reused = np.flatnonzero(reuse_from >= 0)
+    # Written under a temp name and renamed into place, so workers that
+    # memory-mapped the previous file are never pulled from under
+    emb_tmp = paths["embeddings"] + ".tmp.npy"
+    print(f"Computing embeddings for {len(to_encode)} of {len(texts)} products with MiniLM...")
+    if len(reused) == 0:
+        # Full build: vectors stream straight into the output file
+        embeddings = compute_embeddings(texts, out_path=emb_tmp)
+        # normalize embeddings to unit length for cosine similarity with inner product
+        for start in range(0, len(embeddings), EMBED_CHUNK_SIZE):
+            faiss.normalize_L2(embeddings[start:start + EMBED_CHUNK_SIZE])
+    else:
+        encoded = compute_embeddings([texts[i] for i in to_encode]) if len(to_encode) else None
+        if encoded is not None:
+            faiss.normalize_L2(encoded)
+        d = prev["embeddings"].shape[1]
+        embeddings = np.lib.format.open_memmap(emb_tmp, mode="w+", dtype="float32", shape=(len(product_ids), d))
+        for start in range(0, len(reused), EMBED_CHUNK_SIZE):
+            rows = reused[start:start + EMBED_CHUNK_SIZE]
+            embeddings[rows] = prev["embeddings"][reuse_from[rows]]
+        if encoded is not None:
+            embeddings[to_encode] = encoded
+    embeddings.flush()
+
+    # Saved normalized, so the served (memory-mapped) embeddings match the index
+    print("Saving embeddings, ids and catalog snapshot...")
+    os.replace(emb_tmp, paths["embeddings"])
+    save_product_ids(product_ids, paths["product_ids"])
+    save_catalog_snapshot(df, paths["catalog"])
+    np.save(paths["faiss_ids"], faiss_ids)
+    with open(paths["build_state"], "w") as f:
+        json.dump({"index_type": INDEX_TYPE, "embeddings_dtype": EMBEDDINGS_DTYPE, "fingerprints": fingerprints}, f)
+
+    # The float32 file stays the master incremental builds reuse; serving maps
+    # the quantized copy when there is one
+    stored, scale = None, None
+    if EMBEDDINGS_DTYPE != "float32":
+        print(f"Saving {EMBEDDINGS_DTYPE} embeddings...")
+        scale = save_quantized_embeddings(embeddings, EMBEDDINGS_DTYPE, paths["embeddings_q"], paths["embeddings_scale"])
+        stored = np.load(paths["embeddings_q"], mmap_mode="r")
+    # Drop leftovers of an earlier quantized build at the same (legacy) paths
+    if stored is None and os.path.exists(paths["embeddings_q"]):
+        os.remove(paths["embeddings_q"])
+    if scale is None and os.path.exists(paths["embeddings_scale"]):
+        os.remove(paths["embeddings_scale"])
+
+    index = None
+    if prev is not None and (len(stale) == 0 or supports_remove(prev["index"])):
+        print(f"Updating FAISS index in place: -{len(stale)} +{len(to_encode)}...")
+        index = prev["index"]
+        if len(stale):
+            index.remove_ids(stale)
+        if len(to_encode):
+            index.add_with_ids(embeddings[to_encode], faiss_ids[to_encode])
+
+    if index is None:
+        # Build FAISS index (inner product == cosine once vectors are normalized)
+        print(f"Building FAISS index ({INDEX_TYPE})...")
+        index = create_index(embeddings, INDEX_TYPE, ids=faiss_ids)
+    index_tmp = paths["faiss_index"] + ".tmp"
+    faiss.write_index(index, index_tmp)
+    os.replace(index_tmp, paths["faiss_index"])
+    print("FAISS index saved to:", paths["faiss_index"])
+
+    shard_counts = None
+    if INDEX_SHARDS > 1:
+        print(f"Building {INDEX_SHARDS} index shards ({INDEX_TYPE})...")
+        shard_counts = build_shards(embeddings, faiss_ids, product_ids, df, paths["shards"], INDEX_SHARDS)
+    elif os.path.isdir(paths["shards"]):
+        shutil.rmtree(paths["shards"], ignore_errors=True)
+
+    # Item-to-item table for /similar; recomputed for every product since any
+    # catalog change can alter anyone's neighbours
+    if NEIGHBORS_N > 0:
+        print(f"Computing top-{NEIGHBORS_N} neighbours per product...")
+        neighbors, neighbor_scores = neighbor_table(index, embeddings, NEIGHBORS_N, ids=faiss_ids)
+        for name, arr in (("neighbors", neighbors), ("neighbor_scores", neighbor_scores)):
+            tmp = paths[name] + ".tmp.npy"
+            np.save(tmp, arr)
+            os.replace(tmp, paths[name])
+    else:
+        for name in ("neighbors", "neighbor_scores"):
+            if os.path.exists(paths[name]):
+                os.remove(paths[name])
+
+    # Recall@k / latency against exact search as ground truth
+    report = recall_report(embeddings, index, ids=faiss_ids)
+    report.update({"encoded": int(len(to_encode)), "reused": int(len(reused)), "removed": int(len(stale))})
+    if shard_counts is not None:
+        report["shard_rows"] = shard_counts
+    if stored is not None:
+        # Top-k agreement of the served quantized embeddings with float32
+        report["quantization"] = quantization_report(embeddings, stored, scale)
+    write_report(report, paths["report"])
+    print("Index report:", json.dumps(report))
     print("Done.")
 
+def build_version(artifacts_dir=ARTIFACTS_DIR, full=False):
+    """Build into a fresh ARTIFACTS_DIR/<version>/ and publish it as CURRENT.
+    Serving processes pick the new version up without a restart. The
+    currently published build (or the legacy paths) seeds incremental reuse."""
+    os.makedirs(artifacts_dir, exist_ok=True)
+    previous = current_version(artifacts_dir)
+    previous_paths = artifact_paths(None if previous == LEGACY_VERSION else os.path.join(artifacts_dir, previous))
+
+    version, version_dir = new_version_dir(artifacts_dir)
+    build(artifact_paths(version_dir), previous_paths, full=full)
+    publish_version(version, artifacts_dir)
+    print("Published version:", version)
+    return version
+
 if __name__ == "__main__":
-    build()
+    full = "--full" in sys.argv
+    if "--versioned" in sys.argv:
+        build_version(full=full)
+    else:
+        build(full=full)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+One admin build (POST /admin/build), run as its own process:
+
+    python build_job.py <job_id> [--full]
+
+The build does not run inside a serving worker, so it neither takes the
+worker's memory nor dies with it when serve.py replaces workers (SIGHUP, a
+published build, a crash). The caller holds the build lock with the job id
+as its token; this process keeps renewing it while the build runs and
+releases it at the end, so the lock of a build that died expires within
+BUILD_LOCK_TTL and its job is reported failed. Workers pick up the published
+version by polling ARTIFACTS_DIR/CURRENT.
+"""
+import os
+import sys
+import threading
+
+from dotenv import load_dotenv
+
+from redis_client import extend_lock, get_json, release_lock, set_json
+
+load_dotenv()
+
+BUILD_JOB_KEY = "build_job:{job_id}"
+BUILD_LOCK_KEY = "build_lock"
+# Seconds; renewed every third of it while the build is alive
+BUILD_LOCK_TTL = int(os.getenv("BUILD_LOCK_TTL", "60"))
+BUILD_JOB_TTL = int(os.getenv("BUILD_JOB_TTL", "604800"))
+
+
+def run_build_job(job_id: str, full: bool = False):
+    # Imported here: pulls in sentence-transformers
+    from build_embeddings import build_version
+    from model_snapshot import ARTIFACTS_DIR
+
+    done = threading.Event()
+
+    def heartbeat():
+        while not done.wait(BUILD_LOCK_TTL / 3):
+            try:
+                extend_lock(BUILD_LOCK_KEY, job_id, BUILD_LOCK_TTL)
+            except Exception as e:
+                print("Build lock renewal failed:", e)
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    job_key = BUILD_JOB_KEY.format(job_id=job_id)
+    job = get_json(job_key) or {"job_id": job_id}
+    set_json(job_key, {**job, "status": "running"}, ex=BUILD_JOB_TTL)
+    try:
+        version = build_version(ARTIFACTS_DIR, full=full)
+        set_json(job_key, {**job, "status": "done", "version": version}, ex=BUILD_JOB_TTL)
+    except Exception as e:
+        print("Build failed:", e)
+        set_json(job_key, {**job, "status": "failed", "error": str(e)}, ex=BUILD_JOB_TTL)
+    finally:
+        done.set()
+        release_lock(BUILD_LOCK_KEY, job_id)
+
+
+if __name__ == "__main__":
+    run_build_job(sys.argv[1], full="--full" in sys.argv[2:])
@@ -0,0 +1,273 @@
+import os
+import time
+import uuid
+import asyncio
+import threading
+from collections import Counter, OrderedDict
+from dotenv import load_dotenv
+
+from metrics import CACHE_REQUESTS, timed
+from redis_client import acquire_lock, get_many_packed_with_ttl, get_packed_with_ttl, release_lock, set_packed
+
+load_dotenv()
+
+# Entries kept per worker process (0 disables the in-process tier)
+LOCAL_CACHE_SIZE = int(os.getenv("LOCAL_CACHE_SIZE", "10000"))
+
+# Stampede protection: one computation per missing key across all workers
+STAMPEDE_LOCK_TTL = int(os.getenv("STAMPEDE_LOCK_TTL", "30"))
+STAMPEDE_WAIT = float(os.getenv("STAMPEDE_WAIT", "10"))
+STAMPEDE_POLL = 0.05
+
+
+class LRUCache:
+    """Size-bounded LRU with a per-entry TTL. Thread-safe: handlers using it
+    run in the threadpool."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value, ttl: float):
+        if self.maxsize <= 0 or not ttl or ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+_local = LRUCache(LOCAL_CACHE_SIZE)
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+# key -> _Flight of the computation currently running in this process
+_flights = {}
+_flights_lock = threading.Lock()
+# key -> task of the coroutine computation (cache_compute_async) running in
+# this worker's event loop
+_async_flights = {}
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.cached = False
+
+
+def _count(key: str, **deltas):
+    with _stats_lock:
+        _stats.update(deltas)
+    # Keys are "<cache>:...", e.g. recommend / explain
+    cache = key.split(":", 1)[0]
+    for result, n in deltas.items():
+        if n:
+            CACHE_REQUESTS.inc(n, cache=cache, result=result)
+
+
+def _remaining_ttl(ttl: int, pttl: int) -> float:
+    """Seconds a Redis hit may live locally: what the Redis entry has left
+    (PTTL, ms), so the local copy never outlives it; `ttl` for keys that
+    have no expiry."""
+    if pttl == -1:
+        return ttl
+    return min(ttl, pttl / 1000.0) if pttl > 0 else 0
+
+
+def cache_get(key: str, ttl: int):
+    """
+    Look `key` up in this process first, then in Redis. A Redis hit is kept
+    locally for the rest of the Redis entry's TTL, at most `ttl` seconds (keys
+    embed the events hash / model version, so a stale local copy is never
+    served for changed inputs).
+    """
+    with timed("cache_lookup"):
+        value = _local.get(key)
+        if value is not None:
+            _count(key, local_hits=1)
+            return value
+        value, pttl = get_packed_with_ttl(key)
+    if value is None:
+        _count(key, misses=1)
+        return None
+    _count(key, redis_hits=1)
+    _local.set(key, value, _remaining_ttl(ttl, pttl))
+    return value
+
+
+def cache_get_many(keys, ttl: int):
+    """cache_get for several keys; local misses are fetched with a single MGET."""
+    with timed("cache_lookup"):
+        values = [_local.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        fetched = get_many_packed_with_ttl([keys[i] for i in missing]) if missing else []
+    for key, value in zip(keys, values):
+        if value is not None:
+            _count(key, local_hits=1)
+    for i, (value, pttl) in zip(missing, fetched):
+        if value is not None:
+            values[i] = value
+            _local.set(keys[i], value, _remaining_ttl(ttl, pttl))
+            _count(keys[i], redis_hits=1)
+        else:
+            _count(keys[i], misses=1)
+    return values
+
+
+def cache_set(key: str, value, ttl: int, compress: bool = False):
+    """Store `value` (msgpack-able) in Redis and in this process; `compress`
+    zlib-compresses larger payloads in Redis."""
+    with timed("cache_store"):
+        set_packed(key, value, ex=ttl, compress=compress)
+    _local.set(key, value, ttl)
+
+
+def _peek(key: str, ttl: int):
+    value = _local.get(key)
+    if value is not None:
+        return value
+    value, pttl = get_packed_with_ttl(key)
+    if value is not None:
+        _local.set(key, value, _remaining_ttl(ttl, pttl))
+    return value
+
+
+def _wait_for_other_worker(key: str, ttl: int):
+    """Poll the cache while another worker holds the key's lock."""
+    deadline = time.monotonic() + STAMPEDE_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(STAMPEDE_POLL)
+        value = _peek(key, ttl)
+        if value is not None:
+            return value
+    return None
+
+
+def _compute_once(key: str, ttl: int, compute, compress: bool, ttl_of, store):
+    lock_key = f"lock:{key}"
+    token = uuid.uuid4().hex
+    locked = acquire_lock(lock_key, token, STAMPEDE_LOCK_TTL)
+    if not locked:
+        value = _wait_for_other_worker(key, ttl)
+        if value is not None:
+            _count(key, coalesced=1)
+            return value, True
+        # Lock holder is slow or gone: compute rather than fail the request
+    try:
+        value = compute()
+        if value is not None and store(value):
+            cache_set(key, value, ttl_of(value) if ttl_of else ttl, compress=compress)
+        return value, False
+    finally:
+        if locked:
+            release_lock(lock_key, token)
+
+
+def cache_get_or_compute(key: str, ttl: int, compute, compress: bool = False, ttl_of=None,
+                         store=lambda value: True):
+    """
+    Cached value for `key`, or the result of `compute()` stored under it.
+    Concurrent misses for the same key share one computation: requests in
+    this process wait on the in-flight call, other workers wait on a Redis
+    lock and then read the cached value. `compute` returning None means
+    "nothing to cache", as does `store(value)` returning false; `ttl_of(value)`,
+    when given, picks a computed value's TTL instead of `ttl`. Returns
+    (value, cached).
+    """
+    value = cache_get(key, ttl)
+    if value is not None:
+        return value, True
+
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        flight.done.wait(STAMPEDE_WAIT)
+        if flight.value is not None:
+            _count(key, coalesced=1)
+            # Cached only if the shared call itself read it from the cache
+            return flight.value, flight.cached
+        return compute(), False
+
+    try:
+        value, cached = _compute_once(key, ttl, compute, compress, ttl_of, store)
+        flight.value, flight.cached = value, cached
+        return value, cached
+    finally:
+        flight.done.set()
+        with _flights_lock:
+            _flights.pop(key, None)
+
+
+async def _compute_once_async(key: str, ttl: int, compute, compress: bool, store):
+    lock_key = f"lock:{key}"
+    token = uuid.uuid4().hex
+    locked = await asyncio.to_thread(acquire_lock, lock_key, token, STAMPEDE_LOCK_TTL)
+    if not locked:
+        deadline = time.monotonic() + STAMPEDE_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(STAMPEDE_POLL)
+            value = await asyncio.to_thread(_peek, key, ttl)
+            if value is not None:
+                _count(key, coalesced=1)
+                return value, True
+    try:
+        value = await compute()
+        if value is not None and store(value):
+            await asyncio.to_thread(cache_set, key, value, ttl, compress)
+        return value, False
+    finally:
+        if locked:
+            await asyncio.to_thread(release_lock, lock_key, token)
+
+
+async def cache_compute_async(key: str, ttl: int, compute, compress: bool = False,
+                              store=lambda value: True):
+    """
+    Miss path of cache_get_or_compute for a coroutine `compute`, for callers
+    that already looked `key` up (e.g. with cache_get_many). Concurrent calls
+    for the same key share one computation: in this worker they await the
+    same task, other workers wait on the Redis lock; `cached` is true only
+    when the value came from the cache. The result is cached when
+    `store(value)` is true. Cancelling the caller does not cancel the
+    shared computation, which still fills the cache. Returns (value, cached).
+    """
+    flight = _async_flights.get(key)
+    leader = flight is None
+    if leader:
+        flight = _async_flights[key] = asyncio.ensure_future(
+            _compute_once_async(key, ttl, compute, compress, store))
+        flight.add_done_callback(lambda _: _async_flights.pop(key, None))
+    value, cached = await asyncio.shield(flight)
+    if not leader:
+        # Cached only if the shared computation itself read it from the cache
+        _count(key, coalesced=1)
+    return value, cached
+
+
+def cache_stats() -> dict:
+    with _stats_lock:
+        stats = {name: _stats[name] for name in ("local_hits", "redis_hits", "misses", "coalesced")}
+    stats["local_entries"] = len(_local)
+    return stats
@@ -1,36 +1,71 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
 import os
 import json
+import sys
+import uuid
+import asyncio
+import subprocess
+from contextlib import asynccontextmanager
 import numpy as np
 from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import faiss
-from utils import load_products, load_embeddings, compute_embeddings
+from vector_index import search_params
+from model_snapshot import ARTIFACTS_DIR, ModelSnapshot, catalog_mask, current_version, load_snapshot
 from typing import List, Optional
-import math
-import openai
 import uvicorn
-import requests
+import httpx
 import hashlib
-
-# Redis caching
-from redis_client import get_json, set_json
+from datetime import datetime
+
+# Redis caching (results go through the in-process tier in local_cache)
+from redis_client import acquire_lock, get_json, get_list_json, lock_owner, release_lock, set_json
+from build_job import BUILD_JOB_KEY, BUILD_JOB_TTL, BUILD_LOCK_KEY, BUILD_LOCK_TTL
+from local_cache import cache_compute_async, cache_get_many, cache_get_or_compute, cache_set, cache_stats
+from user_profile import profile_seed, read_profile, read_profiles, seeded_field, update_profile
+from micro_batch import MicroBatcher
+from query_encoder import embed_query, normalize_query, warm_encoder
+from shard_client import SHARD_URLS, search_shards, sharded
+from metrics import CANDIDATES, LLM_CALLS, LLM_SECONDS, RequestMetricsMiddleware, render as render_metrics, start_sharing, stop_sharing, timed
 
 load_dotenv()
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
 
 # ----------------------------------------------------
 # CONFIG
 # ----------------------------------------------------
-EMBEDDINGS_PATH = os.getenv("EMBEDDINGS_PATH", "./embeddings.npy")
-FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "./faiss_index.bin")
-PRODUCT_IDS_PATH = os.getenv("PRODUCT_IDS_PATH", "./product_ids.json")
-PRODUCTS_CSV = os.getenv("PRODUCTS_CSV", "../data/products_curated_v3_with_brands.csv")
+# Artifact paths (EMBEDDINGS_PATH, FAISS_INDEX_PATH, ARTIFACTS_DIR, ...) are read in model_snapshot
+
+# How often each worker checks ARTIFACTS_DIR/CURRENT for a newly published build
+SNAPSHOT_POLL_SECONDS = float(os.getenv("SNAPSHOT_POLL_SECONDS", "5"))
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+# Point at a local stub server in tests
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+# Per-call timeout; /explain_batch: concurrent LLM calls per worker, whole-batch deadline
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "8"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+EXPLAIN_BATCH_DEADLINE = float(os.getenv("EXPLAIN_BATCH_DEADLINE", "10"))
 
 TOP_K_DEFAULT = int(os.getenv("TOP_K", "10"))
+# Concurrent single-user searches within this window (or up to the max) share
+# one FAISS call; 0 searches every request on its own
+SEARCH_BATCH_WAIT_MS = float(os.getenv("SEARCH_BATCH_WAIT_MS", "2"))
+SEARCH_BATCH_MAX = int(os.getenv("SEARCH_BATCH_MAX", "64"))
+# Batched searches running at once per worker (FAISS parallelizes within a batch)
+SEARCH_BATCH_INFLIGHT = int(os.getenv("SEARCH_BATCH_INFLIGHT", "1"))
+# Load the MiniLM query encoder in the background at startup instead of on
+# the first /search
+SEARCH_WARM_ENCODER = os.getenv("SEARCH_WARM_ENCODER", "1") == "1"
+MAX_QUERY_CHARS = int(os.getenv("MAX_QUERY_CHARS", "512"))
+# Upper bound of `k` on /similar and /search (FAISS allocates k results per query)
+MAX_K = int(os.getenv("MAX_K", "1000"))
 RANK_ALPHA = float(os.getenv("RANK_ALPHA", "0.7"))
 RANK_BETA = float(os.getenv("RANK_BETA", "0.2"))
 RANK_GAMMA = float(os.getenv("RANK_GAMMA", "0.1"))
@@ -38,15 +73,77 @@ RANK_GAMMA = float(os.getenv("RANK_GAMMA", "0.1"))
 # Redis TTLs
 EXPLAIN_TTL = int(os.getenv("EXPLAIN_TTL", "86400"))     # 24 hours
 RECOMMEND_TTL = int(os.getenv("RECOMMEND_TTL", "300"))   # 5 minutes
+PARTIAL_TTL = int(os.getenv("PARTIAL_TTL", "10"))         # results merged without every index shard
+
+# Per-session event buffer written by the Node backend (eventController.logEvent)
+USER_EVENTS_KEY = "user_events:{user_id}"
 
 # Node backend URL
 NODE_BACKEND = os.getenv("NODE_BACKEND_URL", "http://localhost:5000")
 FRONTEND_ORIGIN = os.getenv("FRONTEND_ORIGIN", "http://localhost:5173")
 
+# Shared HTTP client to the Node backend (keep-alive pool + bounded concurrency)
+NODE_TIMEOUT = float(os.getenv("NODE_TIMEOUT", "3"))
+NODE_MAX_CONNECTIONS = int(os.getenv("NODE_MAX_CONNECTIONS", "100"))
+NODE_MAX_KEEPALIVE = int(os.getenv("NODE_MAX_KEEPALIVE", "20"))
+NODE_MAX_CONCURRENCY = int(os.getenv("NODE_MAX_CONCURRENCY", "64"))
+
+# Requests sending this header (any value but 0) get a Server-Timing response
+# header with the time spent per stage
+TIMING_REQUEST_HEADER = os.getenv("TIMING_REQUEST_HEADER", "X-Timing")
+
 # ----------------------------------------------------
 # INIT
 # ----------------------------------------------------
-app = FastAPI(title="ShopSense Recommender")
+node_client: Optional[httpx.AsyncClient] = None
+node_semaphore: Optional[asyncio.Semaphore] = None
+openai_client: Optional[httpx.AsyncClient] = None
+openai_semaphore: Optional[asyncio.Semaphore] = None
+# CA bundle parsed once per process (before the fork under serve.py) instead
+# of once per client
+TLS_CONTEXT = httpx.create_ssl_context()
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    global node_client, node_semaphore, openai_client, openai_semaphore
+    node_client = httpx.AsyncClient(
+        base_url=NODE_BACKEND,
+        timeout=httpx.Timeout(NODE_TIMEOUT),
+        verify=TLS_CONTEXT,
+        limits=httpx.Limits(
+            max_connections=NODE_MAX_CONNECTIONS,
+            max_keepalive_connections=NODE_MAX_KEEPALIVE,
+        ),
+    )
+    node_semaphore = asyncio.Semaphore(NODE_MAX_CONCURRENCY)
+    openai_client = httpx.AsyncClient(
+        base_url=OPENAI_API_BASE,
+        timeout=httpx.Timeout(OPENAI_TIMEOUT),
+        verify=TLS_CONTEXT,
+        headers={"Authorization": f"Bearer {OPENAI_API_KEY}"} if OPENAI_API_KEY else None,
+    )
+    openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+    # Not awaited: the worker serves while torch loads; a /search arriving
+    # first waits for the model instead
+    warmup = asyncio.create_task(warm_search_encoder()) if SEARCH_WARM_ENCODER else None
+    # Pre-forked workers (serve.py) leave reloads to the parent
+    watcher = asyncio.create_task(watch_snapshot_version()) if SNAPSHOT_WATCH else None
+    start_sharing()
+    try:
+        yield
+    finally:
+        for task in (warmup, watcher):
+            if task is not None:
+                task.cancel()
+        stop_sharing()
+        await node_client.aclose()
+        await openai_client.aclose()
+        node_client = None
+        openai_client = None
+
+
+app = FastAPI(title="ShopSense Recommender", lifespan=lifespan)
 
 # CORS for frontend
 app.add_middleware(
@@ -55,37 +152,52 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
-products_df = load_products(PRODUCTS_CSV)
-product_lookup = {str(r["product_id"]): r.to_dict() for _, r in products_df.iterrows()}
 
-# Load FAISS + embeddings
-if (
-    os.path.exists(EMBEDDINGS_PATH)
-    and os.path.exists(PRODUCT_IDS_PATH)
-):
-    embeddings = np.load(EMBEDDINGS_PATH)
-    PRODUCT_IDS = json.load(open(PRODUCT_IDS_PATH, "r"))
-    # Build or load FAISS index
-    if os.path.exists(FAISS_INDEX_PATH):
-        index = faiss.read_index(FAISS_INDEX_PATH)
-    else:
+app.add_middleware(RequestMetricsMiddleware, timing_header=TIMING_REQUEST_HEADER)
+
+# Current model snapshot. Requests read it once and use that object throughout;
+# a rebuild swaps in a new snapshot with a single assignment.
+# With SHARD_URLS the index lives in the shard servers (shard_server.py) and
+# searches fan out to them
+_snapshot_started = time.perf_counter()
+SNAPSHOT: ModelSnapshot = load_snapshot(load_index=not sharded())
+print(f"[recommender] Startup: imports {IMPORT_SECONDS:.2f}s, snapshot {time.perf_counter() - _snapshot_started:.2f}s")
+# Each worker polls CURRENT itself unless a pre-fork parent does it for them
+SNAPSHOT_WATCH = True
+
+
+def swap_snapshot(snap: ModelSnapshot):
+    global SNAPSHOT
+    SNAPSHOT = snap
+    print("[recommender] Serving model version:", snap.version)
+
+
+def reload_snapshot_if_changed() -> bool:
+    version = current_version(ARTIFACTS_DIR)
+    if version == SNAPSHOT.version:
+        return False
+    swap_snapshot(load_snapshot(ARTIFACTS_DIR, load_index=not sharded()))
+    return True
+
+
+async def watch_snapshot_version():
+    """Pick up builds published by any worker (or an offline build) without a restart."""
+    while True:
+        await asyncio.sleep(SNAPSHOT_POLL_SECONDS)
         try:
-            # Create IndexFlatIP for cosine similarity (with L2-normalized vectors)
-            d = embeddings.shape[1]
-            index = faiss.IndexFlatIP(d)
-            faiss.normalize_L2(embeddings)
-            index.add(embeddings.astype("float32"))
-            faiss.write_index(index, FAISS_INDEX_PATH)
-            print("[recommender] FAISS index built and saved:", FAISS_INDEX_PATH)
+            await run_in_threadpool(reload_snapshot_if_changed)
         except Exception as e:
-            print("[recommender] Failed to build FAISS index:", e)
-            index = None
-else:
-    embeddings = None
-    index = None
-    PRODUCT_IDS = []
+            print("[recommender] Snapshot reload failed:", e)
+
+
+async def warm_search_encoder():
+    try:
+        await run_in_threadpool(warm_encoder)
+    except Exception as e:
+        print("[recommender] Query encoder failed to load:", e)
 
 
 # ----------------------------------------------------
@@ -117,38 +229,132 @@ def clean_json(obj):
             return 0.0
         return obj
     return obj
-def vector_search(query_embedding: np.ndarray, top_k: int = 10):
+def catalog_filter_mask(snap: ModelSnapshot, rows=None,
+                        filter_category: Optional[str] = None,
+                        min_price: Optional[float] = None,
+                        max_price: Optional[float] = None) -> np.ndarray:
+    """Strict category/price filter over the catalog columns, for the given
+    rows (or every row when `rows` is None)."""
+    sel = slice(None) if rows is None else rows
+    return catalog_mask(snap.in_lookup[sel], snap.prices[sel], snap.category_codes[sel], snap.category_vocab,
+                        filter_category, min_price, max_price)
+
+
+def eligible_rows_mask(snap: ModelSnapshot, filter_category: Optional[str] = None,
+                       min_price: Optional[float] = None,
+                       max_price: Optional[float] = None) -> Optional[np.ndarray]:
+    """Rows allowed by the filters, or None when no filter is set."""
+    if not filter_category and min_price is None and max_price is None:
+        return None
+    return catalog_filter_mask(snap, None, filter_category, min_price, max_price)
+
+
+def vector_search(snap: ModelSnapshot, query_embedding: np.ndarray, top_k: int = 10,
+                  allowed: Optional[np.ndarray] = None,
+                  nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """
+    Inner-product search. When `allowed` (a boolean mask over rows) is given,
+    FAISS only scores those rows through an IDSelectorBitmap, so filtered
+    queries still get up to `top_k` eligible neighbours. `nprobe` / `ef_search`
+    override the IVF / HNSW defaults from vector_index.
+    """
+    index = snap.index
     if index is None:
         raise HTTPException(status_code=500, detail="FAISS index not loaded")
 
     q = query_embedding.astype("float32")
     faiss.normalize_L2(q)
-    D, I = index.search(q, top_k)
-    return D, I
 
+    if allowed is None:
+        with timed("vector_search"):
+            D, I = index.search(q, top_k, params=search_params(index, nprobe, ef_search))
+        return D, snap.rows_for_ids(I)
 
-def compute_user_vector_from_events(events: List[dict]):
-    weights = {"view": 1.0, "click": 3.0, "add_to_cart": 5.0, "purchase": 10.0}
+    n_allowed = int(allowed.sum())
+    if n_allowed == 0:
+        return (np.full((len(q), 0), -np.inf, dtype="float32"),
+                np.full((len(q), 0), -1, dtype="int64"))
 
-    vecs = []
-    total_w = 0
+    # The selector sees index ids, which differ from rows after incremental builds
+    id_allowed = snap.id_mask(allowed)
+    bitmap = np.packbits(id_allowed, bitorder="little")
+    sel = faiss.IDSelectorBitmap(len(id_allowed), faiss.swig_ptr(bitmap))
+    params = search_params(index, nprobe, ef_search, sel=sel)
+    with timed("vector_search"):
+        D, I = index.search(q, min(top_k, n_allowed), params=params)
+    return D, snap.rows_for_ids(I)
 
-    for ev in events:
-        pid = str(ev.get("product_id"))
 
+def filtered_search(snap: ModelSnapshot, queries: np.ndarray, top_k: int, filters: tuple = (None, None, None),
+                    nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """
+    vector_search restricted to rows passing `filters` (filter_category,
+    min_price, max_price), as (D, I, complete). In sharded mode every shard
+    applies the filters to its own rows and the per-shard top-k lists are
+    merged by score; `complete` is False when some shard was left out.
+    """
+    if not snap.sharded:
+        D, I = vector_search(snap, queries, top_k=top_k, allowed=eligible_rows_mask(snap, *filters),
+                             nprobe=nprobe, ef_search=ef_search)
+        return D, I, True
+    q = queries.astype("float32")
+    faiss.normalize_L2(q)
+    with timed("vector_search"):
+        D, ids, complete = search_shards(q, top_k, snap.version, *filters, nprobe=nprobe, ef_search=ef_search)
+    return D, snap.rows_for_ids(ids), complete
+
+
+def search_many(items: List[tuple]) -> list:
+    """
+    MicroBatcher processor for vector_search. Each item is (snap, query (1, d),
+    top_k, (filter_category, min_price, max_price), nprobe, ef_search); items
+    sharing the snapshot, filters and ANN knobs are searched as one matrix
+    and each gets its own (D, I, complete) row cut to its top_k.
+    """
+    results = [None] * len(items)
+    groups = {}
+    for pos, (snap, _, _, filters, nprobe, ef_search) in enumerate(items):
+        groups.setdefault((id(snap), filters, nprobe, ef_search), []).append(pos)
+
+    for positions in groups.values():
+        snap, _, _, filters, nprobe, ef_search = items[positions[0]]
         try:
-            idx = PRODUCT_IDS.index(pid)
-        except ValueError:
+            D, I, complete = filtered_search(snap, np.vstack([items[pos][1] for pos in positions]),
+                                             max(items[pos][2] for pos in positions), filters, nprobe, ef_search)
+        except Exception as e:
+            for pos in positions:
+                results[pos] = e
             continue
+        for row, pos in enumerate(positions):
+            top_k = items[pos][2]
+            results[pos] = (D[row:row + 1, :top_k], I[row:row + 1, :top_k], complete)
+    return results
+
+
+search_batcher = MicroBatcher(search_many, max_batch=SEARCH_BATCH_MAX, max_wait=SEARCH_BATCH_WAIT_MS / 1000.0,
+                              max_inflight=SEARCH_BATCH_INFLIGHT, name="search_batch")
+
+
+EVENT_WEIGHTS = {"view": 1.0, "click": 3.0, "add_to_cart": 5.0, "purchase": 10.0}
 
-        w = weights.get(ev.get("event_type", "view"), 1.0)
-        vecs.append(embeddings[idx] * w)
-        total_w += w
 
-    if not vecs:
+def compute_user_vector_from_events(snap: ModelSnapshot, events: List[dict]):
+    rows = []
+    weights = []
+
+    for ev in events:
+        idx = snap.product_index.get(str(ev.get("product_id")))
+        if idx is None:
+            continue
+        rows.append(idx)
+        weights.append(EVENT_WEIGHTS.get(ev.get("event_type", "view"), 1.0))
+
+    if not rows:
         return None
 
-    user_vec = sum(vecs) / max(total_w, 1.0)
+    # One gather + one weighted reduction instead of a per-event Python sum
+    w = np.asarray(weights, dtype="float32")
+    user_vec = (w @ snap.vectors(rows)) / max(float(w.sum()), 1.0)
 
     norm = np.linalg.norm(user_vec)
     if norm > 0:
@@ -173,7 +379,7 @@ def template_explain(user_id: str, product: dict, events: List[dict]):
 
     for ev in events:
         pid = ev.get("product_id")
-        p = product_lookup.get(str(pid))
+        p = SNAPSHOT.product_lookup.get(str(pid))
 
         if not p:
             continue
@@ -199,15 +405,10 @@ def template_explain(user_id: str, product: dict, events: List[dict]):
     return base + suffix
 
 
-def call_openai_explain(user_id: str, product: dict, events: List[dict],
-                        filter_category: Optional[str] = None,
-                        min_price: Optional[float] = None,
-                        max_price: Optional[float] = None):
-    if not OPENAI_API_KEY:
-        return {"text": template_explain(user_id, product, events), "source": "template"}
-
-    openai.api_key = OPENAI_API_KEY
-
+def explain_prompt(product: dict, events: List[dict],
+                   filter_category: Optional[str] = None,
+                   min_price: Optional[float] = None,
+                   max_price: Optional[float] = None) -> str:
     context = [f"{ev['event_type']}:{ev['product_id']}" for ev in events[-6:]]
 
     filters_text = ""
@@ -217,7 +418,7 @@ def call_openai_explain(user_id: str, product: dict, events: List[dict],
         both = ", ".join([p for p in [cat, pr] if p])
         filters_text = f"\nUser selected filters: {both}"
 
-    prompt = f"""
+    return f"""
 User recent actions: {context}{filters_text}
 
 Product:
@@ -229,13 +430,35 @@ Product:
 Write a concise, helpful explanation (2 sentences) of why this product is recommended, referencing both recent activity and selected filters when provided.
 """
 
+
+def call_openai_explain(user_id: str, product: dict, events: List[dict],
+                        filter_category: Optional[str] = None,
+                        min_price: Optional[float] = None,
+                        max_price: Optional[float] = None):
+    if not OPENAI_API_KEY:
+        LLM_CALLS.inc(outcome="disabled")
+        return {"text": template_explain(user_id, product, events), "source": "template"}
+
+    # Imported on first use: the SDK pulls in requests/aiohttp, half a second
+    # of startup for workers that mostly answer from the template or cache
+    import openai
+
+    openai.api_key = OPENAI_API_KEY
+    openai.api_base = OPENAI_API_BASE
+
+    prompt = explain_prompt(product, events, filter_category, min_price, max_price)
+
+    t0 = time.perf_counter()
     try:
         resp = openai.ChatCompletion.create(
             model=OPENAI_MODEL,
             messages=[{"role": "user", "content": prompt}],
             max_tokens=80,
             temperature=0.25,
+            request_timeout=OPENAI_TIMEOUT,
         )
+        LLM_SECONDS.observe(time.perf_counter() - t0, mode="sync")
+        LLM_CALLS.inc(outcome="openai")
 
         return {
             "text": resp["choices"][0]["message"]["content"].strip(),
@@ -243,6 +466,8 @@ Write a concise, helpful explanation (2 sentences) of why this product is recomm
         }
 
     except Exception as e:
+        LLM_SECONDS.observe(time.perf_counter() - t0, mode="sync")
+        LLM_CALLS.inc(outcome="error")
         return {
             "text": template_explain(user_id, product, events),
             "source": "template",
@@ -250,56 +475,227 @@ Write a concise, helpful explanation (2 sentences) of why this product is recomm
         }
 
 
+async def call_openai_explain_async(user_id: str, product: dict, events: List[dict],
+                                    filter_category: Optional[str] = None,
+                                    min_price: Optional[float] = None,
+                                    max_price: Optional[float] = None):
+    """Non-blocking call_openai_explain over the shared HTTP client, bounded
+    by OPENAI_MAX_CONCURRENCY and OPENAI_TIMEOUT per call."""
+    if not OPENAI_API_KEY:
+        LLM_CALLS.inc(outcome="disabled")
+        return {"text": template_explain(user_id, product, events), "source": "template"}
+
+    body = {
+        "model": OPENAI_MODEL,
+        "messages": [{"role": "user", "content": explain_prompt(product, events, filter_category, min_price, max_price)}],
+        "max_tokens": 80,
+        "temperature": 0.25,
+    }
+    try:
+        async with openai_semaphore:
+            t0 = time.perf_counter()
+            try:
+                resp = await asyncio.wait_for(openai_client.post("/chat/completions", json=body), OPENAI_TIMEOUT)
+            finally:
+                LLM_SECONDS.observe(time.perf_counter() - t0, mode="async")
+        resp.raise_for_status()
+        text = resp.json()["choices"][0]["message"]["content"].strip()
+        LLM_CALLS.inc(outcome="openai")
+        return {"text": text, "source": "openai"}
+    except Exception as e:
+        LLM_CALLS.inc(outcome="error")
+        return {
+            "text": template_explain(user_id, product, events),
+            "source": "template",
+            "error": str(e) or type(e).__name__,
+        }
+
+
 # ----------------------------------------------------
 # ENDPOINTS
 # ----------------------------------------------------
 
 @app.get("/health")
 def health():
+    snap = SNAPSHOT
     return {
         "status": "ok",
-        "faiss_loaded": index is not None,
-        "total_products": len(PRODUCT_IDS),
+        "faiss_loaded": snap.index is not None or snap.sharded,
+        "shards": len(SHARD_URLS) if snap.sharded else 0,
+        "total_products": len(snap.product_ids),
+        "model_version": snap.version,
+        "cache": cache_stats(),
     }
 
 
-@app.post("/admin/build")
-def admin_build():
-    from build_embeddings import build
-    build()
-    return {"status": "rebuilt"}
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus text exposition of the counters and histograms: this
+    worker's, or every worker's summed when METRICS_DIR is set."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+# ---------------- ADMIN BUILD ----------------
+BUILD_JOB_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "build_job.py")
+
+
+def start_build_process(job_id: str, full: bool = False) -> subprocess.Popen:
+    """Run the build in its own process (see build_job), in a new session so
+    it outlives this worker."""
+    return subprocess.Popen([sys.executable, BUILD_JOB_SCRIPT, job_id] + (["--full"] if full else []),
+                            start_new_session=True)
+
+
+@app.post("/admin/build", status_code=202)
+async def admin_build(full: bool = False):
+    """
+    Start a rebuild in a separate process and return a job id to poll. Only
+    one build runs at a time across workers (Redis lock); when it finishes the
+    new version is published and every worker swaps to it. Builds are
+    incremental (only new/changed products are re-encoded) unless `full=true`.
+    """
+    job_id = uuid.uuid4().hex
+    if not await run_in_threadpool(acquire_lock, BUILD_LOCK_KEY, job_id, BUILD_LOCK_TTL):
+        return {"status": "running", "job_id": await run_in_threadpool(lock_owner, BUILD_LOCK_KEY)}
+
+    job_key = BUILD_JOB_KEY.format(job_id=job_id)
+    job = {"job_id": job_id, "status": "queued", "full": full, "previous_version": SNAPSHOT.version}
+    await run_in_threadpool(set_json, job_key, job, BUILD_JOB_TTL)
+    try:
+        proc = start_build_process(job_id, full)
+    except OSError as e:
+        print("[recommender] Build failed to start:", e)
+        await run_in_threadpool(set_json, job_key, {**job, "status": "failed", "error": str(e)}, BUILD_JOB_TTL)
+        await run_in_threadpool(release_lock, BUILD_LOCK_KEY, job_id)
+        raise HTTPException(status_code=503, detail="Could not start build")
+    # Waited on off the event loop, so the finished process does not linger
+    asyncio.get_running_loop().run_in_executor(None, proc.wait)
+    return {"status": "queued", "job_id": job_id}
+
+
+@app.get("/admin/build/{job_id}")
+def admin_build_status(job_id: str):
+    # Lock first: a finished build writes its status before releasing it
+    owner = lock_owner(BUILD_LOCK_KEY)
+    job_key = BUILD_JOB_KEY.format(job_id=job_id)
+    job = get_json(job_key)
+    if not job:
+        raise HTTPException(status_code=404, detail="Unknown build job")
+    if job.get("status") in ("queued", "running") and owner != job_id:
+        # The build process died, or ran past BUILD_LOCK_TTL
+        job = {**job, "status": "failed", "error": "build process exited or its lock expired"}
+        set_json(job_key, job, ex=BUILD_JOB_TTL)
+    return job
 
 
 # ---------------- PRODUCT LOOKUP ----------------
 @app.get("/product/{product_id}")
 def get_product(product_id: str):
+    product_lookup = SNAPSHOT.product_lookup
     if product_id not in product_lookup:
         raise HTTPException(status_code=404, detail="Not found")
     return product_lookup[product_id]
 
 
+# ---------------- SIMILAR PRODUCTS ----------------
+def similar_rows(snap: ModelSnapshot, row: int, n: int):
+    """(rows, scores, complete) most similar to `row`: a lookup in the
+    precomputed neighbour table, or a live index search for builds without
+    one and for `n` beyond the table's width."""
+    if snap.neighbors is not None and n <= snap.neighbors.shape[1]:
+        return np.asarray(snap.neighbors[row]), np.asarray(snap.neighbor_scores[row], dtype="float32"), True
+    D, I, complete = filtered_search(snap, snap.vectors([row]), n + 1)
+    return I[0], D[0], complete
+
+
+@app.get("/similar/{product_id}")
+def similar_products(product_id: str, k: int = Query(TOP_K_DEFAULT, ge=1, le=MAX_K)):
+    snap = SNAPSHOT
+    row = snap.product_index.get(product_id)
+    if row is None or product_id not in snap.product_lookup:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    try:
+        rows, scores, complete = similar_rows(snap, row, k)
+    except RuntimeError as e:
+        print("Similar search error:", e)
+        raise HTTPException(status_code=503, detail="Index unavailable")
+    results = []
+    seen = {product_id}
+    for r, score in zip(rows.tolist(), scores.tolist()):
+        if r < 0:
+            continue
+        pid = snap.product_ids[r]
+        if pid in seen or pid not in snap.product_lookup:
+            continue
+        results.append({"product_id": pid, "score": float(score), "product": clean_json(snap.product_lookup[pid])})
+        seen.add(pid)
+        if len(results) >= k:
+            break
+    return with_partial({"product_id": product_id, "results": results}, not complete)
+
+
+# ---------------- SEARCH ----------------
+@app.get("/search")
+def search(
+    q: str = Query(..., min_length=1, max_length=MAX_QUERY_CHARS),
+    k: int = Query(TOP_K_DEFAULT, ge=1, le=MAX_K),
+    filter_category: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    nprobe: Optional[int] = Query(None, ge=1),
+    ef_search: Optional[int] = Query(None, ge=1),
+):
+    """
+    Free-text product search. The query is embedded with the build's MiniLM
+    model (cached per normalized query; concurrent queries are encoded as one
+    batch), searched through the FAISS index and ranked with the same filters
+    and weights as /recommend.
+    """
+    snap = SNAPSHOT
+    query = normalize_query(q)
+    if not query:
+        raise HTTPException(status_code=400, detail="Empty query")
+    if not snap.loaded:
+        return {"query": q, "results": []}
+
+    try:
+        query_vec = embed_query(query)
+    except Exception as e:
+        print("Query encode error:", e)
+        raise HTTPException(status_code=503, detail="Query encoder unavailable")
+    if query_vec.shape[1] != snap.embeddings.shape[1]:
+        raise HTTPException(status_code=503, detail="Index was built with a different encoder")
+
+    try:
+        D, I, complete = search_batcher.submit((snap, query_vec, candidate_pool_size(k),
+                                                (filter_category, min_price, max_price), nprobe, ef_search))
+    except RuntimeError as e:
+        # Sharded mode with no shard reachable
+        print("Search error:", e)
+        raise HTTPException(status_code=503, detail="Index unavailable")
+    return with_partial({"query": q, "results": rank_candidates(snap, D[0], I[0], k, filter_category, min_price, max_price)},
+                        not complete)
+
+
 # ---------------- SESSION SUMMARY ----------------
 @app.get("/session_summary/{session_id}")
-def session_summary(session_id: str):
+async def session_summary(session_id: str):
     """
     Fetch user events from Node backend and return a normalized event list.
     """
     try:
-        resp = requests.get(f"{NODE_BACKEND}/api/events/{session_id}", timeout=3)
-
-        if resp.status_code == 200:
-            data = resp.json()
-            logs = data.get("recent_events", [])
+        logs = await fetch_events(session_id)
 
-            cleaned = []
-            for ev in logs:
-                cleaned.append({
-                    "event_type": ev.get("event_type"),
-                    "product_id": ev.get("product_id"),
-                    "timestamp": ev.get("createdAt")
-                })
+        cleaned = []
+        for ev in logs:
+            cleaned.append({
+                "event_type": ev.get("event_type"),
+                "product_id": ev.get("product_id"),
+                "timestamp": ev.get("createdAt")
+            })
 
-            return {"session_id": session_id, "recent_events": cleaned}
+        return {"session_id": session_id, "recent_events": cleaned}
 
     except Exception as e:
         print("Event fetch error:", e)
@@ -307,188 +703,658 @@ def session_summary(session_id: str):
     return {"session_id": session_id, "recent_events": []}
 
 
+# ---------------- USER PROFILE ----------------
+class ProfileEvent(BaseModel):
+    user_id: str
+    product_id: str
+    event_type: str = "view"
+    ts: Optional[float] = None  # epoch seconds; defaults to now
+
+
+def event_epoch(value) -> Optional[float]:
+    """Epoch seconds of an event's `createdAt` (ISO string or epoch number)."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return None
+
+
+def product_category(snap: ModelSnapshot, product_id) -> Optional[str]:
+    category = (snap.product_lookup.get(str(product_id)) or {}).get("normalized_top_category")
+    return category if isinstance(category, str) else None
+
+
+def seed_from_events(snap: ModelSnapshot, events: List[dict], before: float) -> Optional[dict]:
+    """A profile seed (see user_profile.profile_seed) from the user's event
+    history older than `before`, or None when no event is in the catalog."""
+    rows, weights, ts, categories, seeded = [], [], [], [], []
+    for ev in events:
+        row = snap.product_index.get(str(ev.get("product_id")))
+        at = event_epoch(ev.get("createdAt"))
+        # The event being folded is usually in the history already (same
+        # millisecond, possibly off by float rounding)
+        if row is None or at is None or at >= before - 0.001:
+            continue
+        event_type = ev.get("event_type") or "view"
+        rows.append(row)
+        weights.append(EVENT_WEIGHTS.get(event_type, 1.0))
+        ts.append(at)
+        categories.append(product_category(snap, ev.get("product_id")))
+        seeded.append(seeded_field(str(ev.get("product_id")), event_type, at))
+    if not rows:
+        return None
+    return profile_seed(snap.vectors(rows), weights, ts, categories, seeded)
+
+
+@app.post("/profile/event", status_code=202)
+async def profile_event(ev: ProfileEvent):
+    """
+    Fold one user event into the user's running profile vector (called by the
+    Node backend for every logged event). /recommend then reads the profile
+    instead of fetching and re-embedding the event list.
+
+    A user without a profile for the serving build (first event since the
+    rollout or a rebuild, or a profile expired / dropped after a failed
+    update) is first seeded from their event history, in the same Redis
+    transaction as the event, so the profile never covers less than the
+    events would. If the history cannot be fetched, the build is not loaded
+    or the product is not in it, nothing is written and the error status
+    makes the backend drop the profile, so /recommend keeps using the events.
+    """
+    snap = SNAPSHOT
+    if not snap.loaded:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    row = snap.product_index.get(str(ev.product_id))
+    if row is None:
+        raise HTTPException(status_code=404, detail="Unknown product")
+    ts = ev.ts if ev.ts is not None else time.time()
+    seed = None
+    try:
+        if usable_profile(snap, await run_in_threadpool(read_profile, ev.user_id)) is None:
+            events = await fetch_events(ev.user_id)
+            seed = await run_in_threadpool(seed_from_events, snap, events, ts)
+    except Exception as e:
+        print("Profile seed error:", e)
+        raise HTTPException(status_code=503, detail="Could not seed profile")
+    try:
+        gen, seeded = await run_in_threadpool(
+            update_profile,
+            ev.user_id, snap.vectors([row])[0], EVENT_WEIGHTS.get(ev.event_type, 1.0), snap.version,
+            category=product_category(snap, ev.product_id), ts=ts,
+            event=seeded_field(str(ev.product_id), ev.event_type, ts), seed=seed,
+        )
+    except Exception as e:
+        print("Profile update error:", e)
+        raise HTTPException(status_code=503, detail="Could not update profile")
+    return {"updated": True, "generation": gen, "seeded": seeded}
+
+
 # ---------------- RECOMMEND ----------------
-@app.get("/recommend")
-def recommend(
-    user_id: str = Query(...),
-    k: int = TOP_K_DEFAULT,
-    filter_category: Optional[str] = None,
-    min_price: Optional[float] = None,
+MAX_BATCH_USERS = int(os.getenv("MAX_BATCH_USERS", "1000"))
+
+
+class RecommendRequest(BaseModel):
+    user_id: str
+    k: int = TOP_K_DEFAULT
+    filter_category: Optional[str] = None
+    min_price: Optional[float] = None
     max_price: Optional[float] = None
-):
-    # fetch real user events
-    summary = requests.get(f"{NODE_BACKEND}/api/events/{user_id}").json()
-    events = summary.get("recent_events", [])
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
 
-    # If a category filter is set, require that the session has activity in that category
-    if filter_category:
-        has_activity_in_category = False
-        for ev in events:
-            pid = str(ev.get("product_id"))
-            prod = product_lookup.get(pid)
-            if prod and prod.get("normalized_top_category") == filter_category:
-                has_activity_in_category = True
-                break
-        if not has_activity_in_category:
-            # Strict behavior: no activity in requested category → no recommendations
-            return {"cached": False, "results": []}
-
-    # cache key
-    evhash = events_hash(events)
+
+class RecommendBatchRequest(BaseModel):
+    requests: List[RecommendRequest]
+
+
+def read_buffered_events(user_id: str) -> Optional[List[dict]]:
+    """Recent events from the Redis `user_events:{id}` list (newest first),
+    shaped like the Node API response. None when the buffer is missing."""
+    try:
+        buffered = get_list_json(USER_EVENTS_KEY.format(user_id=user_id))
+    except Exception as e:
+        print("Redis event buffer error:", e)
+        return None
+    if buffered is None:
+        return None
+    return [
+        {
+            "event_type": ev.get("event_type"),
+            "product_id": ev.get("product_id"),
+            "createdAt": ev.get("ts"),
+        }
+        for ev in buffered
+        if isinstance(ev, dict)
+    ]
+
+
+async def fetch_events(user_id: str) -> List[dict]:
+    """Recent session events, read from the Redis buffer when present and
+    otherwise fetched from the Node backend over the shared pool."""
+    with timed("event_fetch"):
+        buffered = await run_in_threadpool(read_buffered_events, user_id)
+        if buffered is not None:
+            return buffered
+
+        async with node_semaphore:
+            resp = await node_client.get(f"/api/events/{user_id}")
+        resp.raise_for_status()
+        return resp.json().get("recent_events", [])
+
+
+async def fetch_events_or_502(user_id: str) -> List[dict]:
+    try:
+        return await fetch_events(user_id)
+    except Exception as e:
+        print("Event fetch error:", e)
+        raise HTTPException(status_code=502, detail="Could not fetch user events")
+
+
+def has_category_activity(snap: ModelSnapshot, events: List[dict], filter_category: str,
+                          profile: Optional[dict] = None) -> bool:
+    if profile is not None:
+        return profile["categories"].get(filter_category, 0) > 0
+    for ev in events:
+        pid = str(ev.get("product_id"))
+        prod = snap.product_lookup.get(pid)
+        if prod and prod.get("normalized_top_category") == filter_category:
+            return True
+    return False
+
+
+def recommend_cache_key(snap, user_id, events, filter_category, min_price, max_price, k,
+                        nprobe=None, ef_search=None, profile=None):
+    # A profile generation only changes when the profile drifts, so small
+    # updates keep hitting the same entry; the raw event list changes every event
+    evhash = f"p{profile['gen']}" if profile is not None else events_hash(events)
+    if is_cold_start(events, profile):
+        # Cold-start results do not depend on the user: one entry for everyone
+        user_id = "_cold"
     fcat = filter_category or "all"
     mp = "none" if min_price is None else str(min_price)
     xp = "none" if max_price is None else str(max_price)
-    cache_key = f"recommend:{user_id}:{evhash}:{fcat}:{mp}:{xp}:k{k}"
+    # Model version in the key: a rebuild takes effect without waiting for TTLs
+    key = f"recommend:{snap.version}:{user_id}:{evhash}:{fcat}:{mp}:{xp}:k{k}"
+    # ANN knobs change the result set, so explicit overrides get their own entry
+    if nprobe is not None:
+        key += f":np{nprobe}"
+    if ef_search is not None:
+        key += f":ef{ef_search}"
+    return key
+
+
+def usable_profile(snap: ModelSnapshot, profile: Optional[dict]) -> Optional[dict]:
+    """`profile` if it was built against the serving snapshot, else None."""
+    if profile is None or snap.embeddings is None:
+        return None
+    return profile if profile["version"] == snap.version else None
 
-    cached = get_json(cache_key)
-    if cached:
-        return {"cached": True, "results": cached}
 
-    # compute user vector
-    if index is None or embeddings is None or len(PRODUCT_IDS) == 0:
-        # If model assets are not loaded, return empty gracefully
-        return {"cached": False, "results": []}
+def session_vector(snap: ModelSnapshot, events: List[dict], profile: Optional[dict] = None):
+    """The incremental profile vector when there is one, else built from events."""
+    if profile is not None:
+        return profile["vector"]
+    with timed("user_vector"):
+        return query_vector_for_events(snap, events)
 
-    if events:
-        user_vec = compute_user_vector_from_events(events)
-    else:
-        # Fallback to global centroid
-        try:
-            user_vec = np.nanmean(embeddings, axis=0).reshape(1, -1)
-        except Exception:
-            return {"cached": False, "results": []}
-        # Replace non-finite with zeros before normalization
-        user_vec = np.where(np.isfinite(user_vec), user_vec, 0.0)
-        faiss.normalize_L2(user_vec)
 
-    # FAISS search with larger candidate set
-    try:
-        D, I = vector_search(user_vec, top_k=max(k * 5, 50))
-    except Exception:
-        return {"cached": False, "results": []}
+def candidate_pool_size(k: int) -> int:
+    return max(k * 5, 50)
 
-    raw_candidates = []
-    for sim_row, idx_row in zip(D.tolist(), I.tolist()):
-        for sim, idx in zip(sim_row, idx_row):
-            # Skip non-finite similarities
-            try:
-                sf = float(sim)
-            except Exception:
-                continue
-            if not math.isfinite(sf):
-                continue
-            pid = PRODUCT_IDS[idx]
-            prod = product_lookup.get(pid)
-            if not prod:
-                continue
 
-            # Price checks (strict filter: drop if outside range)
-            try:
-                p = float(prod.get("price") or 0)
-            except Exception:
-                p = 0.0
-            if min_price is not None and p < float(min_price):
-                continue
-            if max_price is not None and p > float(max_price):
-                continue
+def query_vector_for_events(snap: ModelSnapshot, events: List[dict]):
+    """User vector for the session, or the normalized global centroid when
+    there is no activity. Returns None if no vector can be built."""
+    if events:
+        return compute_user_vector_from_events(snap, events)
 
-            # Category filter (strict: include only matching category if set)
-            if filter_category and prod.get("normalized_top_category") != filter_category:
-                continue
+    # Fallback to global centroid (precomputed with the snapshot)
+    return snap.centroid
 
-            # Category match flag for scoring info
-            cat_match = 1 if (filter_category and prod.get("normalized_top_category") == filter_category) else 0
 
-            raw_candidates.append((pid, sf, prod, cat_match))
+def is_cold_start(events: List[dict], profile: Optional[dict] = None) -> bool:
+    return profile is None and not events
 
-    # Candidates are already strictly filtered above
-    filtered = raw_candidates
-    fallback_pool = []
 
-    # Scoring
-    def norm_sim(x: float) -> float:
-        # Handle NaN/inf and clamp to [0,1]
-        try:
-            xf = float(x)
-        except Exception:
-            return 0.0
-        if not math.isfinite(xf):
-            return 0.0
-        return max(0.0, min(1.0, xf))
-
-    results_scored = []
-    for pid, sim, prod, cat_match in filtered:
-        ns = norm_sim(sim)
-        # price proximity (optional additive score, only if range given)
-        if min_price is not None and max_price is not None and float(max_price) > float(min_price):
-            mid = (float(min_price) + float(max_price)) / 2.0
-            rng = (float(max_price) - float(min_price)) + 1.0
-            try:
-                pp = float(prod.get("price") or 0)
-            except Exception:
-                pp = 0.0
-            price_score = max(0.0, 1.0 - abs(pp - mid) / rng)
-        else:
-            price_score = 0.0
+def cold_start_candidates(snap: ModelSnapshot, top_k: int, allowed: Optional[np.ndarray] = None):
+    """
+    Exact top `top_k` rows by similarity to the catalog centroid, restricted
+    to `allowed`, read from the snapshot's precomputed ordering instead of a
+    FAISS search. Returns (sims, rows) shaped like vector_search output.
+    """
+    with timed("cold_start"):
+        order = snap.cold_order
+        if allowed is not None:
+            order = order[allowed[order]]
+        rows = order[:top_k].astype("int64")
+    return snap.cold_scores[rows].reshape(1, -1), rows.reshape(1, -1)
+
+
+def rank_candidates(snap: ModelSnapshot, sim_row, idx_row, k: int,
+                    filter_category: Optional[str] = None,
+                    min_price: Optional[float] = None,
+                    max_price: Optional[float] = None):
+    """Filter and score one row of FAISS results, returning the top-k entries.
+    Filtering and scoring run as array masks over the catalog columns."""
+    if k <= 0:
+        return []
+    with timed("rank"):
+        return _rank_row(snap, sim_row, idx_row, k, filter_category, min_price, max_price)
+
+
+def _rank_row(snap: ModelSnapshot, sim_row, idx_row, k: int, filter_category, min_price, max_price):
+    sims = np.asarray(sim_row, dtype="float64").ravel()
+    rows = np.asarray(idx_row, dtype="int64").ravel()
+
+    # Skip non-finite similarities, FAISS padding (-1) and rows without metadata
+    keep = np.isfinite(sims) & (rows >= 0) & (rows < len(snap.in_lookup))
+    sims, rows = sims[keep], rows[keep]
+    keep = catalog_filter_mask(snap, rows, filter_category, min_price, max_price)
+    prices = snap.prices[rows]
+
+    sims, rows, prices = sims[keep], rows[keep], prices[keep]
+    CANDIDATES.observe(len(keep), stage="retrieved")
+    CANDIDATES.observe(len(rows), stage="kept")
+    if len(rows) == 0:
+        return []
+
+    # Scoring: similarity clamped to [0,1], every survivor matches the category
+    ns = np.clip(sims, 0.0, 1.0)
+    if min_price is not None and max_price is not None and float(max_price) > float(min_price):
+        mid = (float(min_price) + float(max_price)) / 2.0
+        rng = (float(max_price) - float(min_price)) + 1.0
+        price_score = np.nan_to_num(np.maximum(0.0, 1.0 - np.abs(prices - mid) / rng), nan=0.0)
+    else:
+        price_score = 0.0
 
-        final = RANK_ALPHA * ns + RANK_BETA * (cat_match if filter_category else 0.0) + RANK_GAMMA * price_score
-        if not math.isfinite(final):
-            final = 0.0
-        results_scored.append((final, pid, sim, prod))
+    final = RANK_ALPHA * ns + RANK_BETA * (1.0 if filter_category else 0.0) + RANK_GAMMA * price_score
+    final = np.where(np.isfinite(final), final, 0.0)
+
+    # Top-k by final score (ties keep FAISS order); widen to a full sort only
+    # if duplicate product ids pushed us below k
+    if len(final) > k:
+        top = np.argpartition(-final, k - 1)[:k]
+        top = top[np.lexsort((top, -final[top]))]
+    else:
+        top = np.lexsort((np.arange(len(final)), -final))
+
+    chosen = _pick_unique(snap, top, rows, final, k)
+    if len(chosen) < k and len(top) < len(final):
+        chosen = _pick_unique(snap, np.lexsort((np.arange(len(final)), -final)), rows, final, k)
+    return chosen
 
-    # Sort by final score
-    results_scored.sort(key=lambda t: t[0], reverse=True)
 
-    # Fill up to k, using fallback pool if necessary
+def _pick_unique(snap: ModelSnapshot, order, rows, final, k: int):
     chosen = []
     seen = set()
-    for final, pid, sim, prod in results_scored:
+    for i in order:
+        pid = snap.product_ids[rows[i]]
         if pid in seen:
             continue
-        chosen.append({"product_id": pid, "score": final, "product": clean_json(prod)})
+        chosen.append({"product_id": pid, "score": float(final[i]), "product": clean_json(snap.product_lookup[pid])})
         seen.add(pid)
         if len(chosen) >= k:
             break
+    return chosen
+
+
+def compact_results(chosen: List[dict]) -> List[list]:
+    """Cache form of ranked results: [product_id, score] pairs only."""
+    return [[c["product_id"], c["score"]] for c in chosen]
+
+
+def hydrate_results(snap: ModelSnapshot, cached: List[list]) -> List[dict]:
+    """Rebuild full results from cached [product_id, score] pairs and the catalog."""
+    return [
+        {"product_id": pid, "score": score, "product": clean_json(snap.product_lookup[pid])}
+        for pid, score in cached
+        if pid in snap.product_lookup
+    ]
+
+
+def cache_form(compact: list, complete: bool = True):
+    """Results as cached: the compact list, or, when some index shard was
+    left out of the search, a {"partial": True, "results": compact} marker so
+    every reader of the entry reports it."""
+    return compact if complete else {"partial": True, "results": compact}
+
+
+def split_partial(value):
+    """(compact results, partial) of a cached recommend value."""
+    if isinstance(value, dict):
+        return value.get("results", []), bool(value.get("partial"))
+    return value, False
+
+
+def recommend_ttl(value) -> int:
+    # Partial merges are only kept until the missing shards are likely back
+    return PARTIAL_TTL if split_partial(value)[1] else RECOMMEND_TTL
+
+
+def with_partial(response: dict, partial: bool) -> dict:
+    if partial:
+        response["partial"] = True
+    return response
+
+
+def compute_recommendations(snap: ModelSnapshot, events: List[dict], k: int,
+                            filter_category: Optional[str] = None,
+                            min_price: Optional[float] = None,
+                            max_price: Optional[float] = None,
+                            nprobe: Optional[int] = None,
+                            ef_search: Optional[int] = None,
+                            profile: Optional[dict] = None):
+    """Ranked results in cache form (see split_partial), or None when nothing
+    can be computed."""
+    # compute user vector
+    if not snap.loaded:
+        # If model assets are not loaded, return empty gracefully
+        return None
+
+    if is_cold_start(events, profile) and snap.cold_order is not None:
+        allowed = eligible_rows_mask(snap, filter_category, min_price, max_price)
+        D, I = cold_start_candidates(snap, candidate_pool_size(k), allowed)
+        return compact_results(rank_candidates(snap, D[0].tolist(), I[0].tolist(), k,
+                                               filter_category, min_price, max_price))
+
+    user_vec = session_vector(snap, events, profile)
+    if user_vec is None:
+        return None
+
+    # FAISS search with larger candidate set, restricted to rows matching the filters;
+    # batched with concurrent requests
+    try:
+        D, I, complete = search_batcher.submit((snap, user_vec, candidate_pool_size(k),
+                                                (filter_category, min_price, max_price), nprobe, ef_search))
+    except Exception:
+        return None
+
+    chosen = rank_candidates(snap, D[0].tolist(), I[0].tolist(), k, filter_category, min_price, max_price)
+    return cache_form(compact_results(chosen), complete)
+
+
+def recommend_for_events(user_id: str, events: List[dict], k: int,
+                         filter_category: Optional[str] = None,
+                         min_price: Optional[float] = None,
+                         max_price: Optional[float] = None,
+                         nprobe: Optional[int] = None,
+                         ef_search: Optional[int] = None,
+                         profile: Optional[dict] = None):
+    """Blocking part of /recommend (Redis, NumPy, FAISS); run off the event loop.
+    With a user `profile` (see user_profile), it replaces the event list."""
+    snap = SNAPSHOT
+
+    # If a category filter is set, require that the session has activity in that category
+    if filter_category and not has_category_activity(snap, events, filter_category, profile):
+        # Strict behavior: no activity in requested category → no recommendations
+        return {"cached": False, "results": []}
+
+    cache_key = recommend_cache_key(snap, user_id, events, filter_category, min_price, max_price, k,
+                                    nprobe, ef_search, profile)
+    # Concurrent misses for the same key (any worker) share one computation
+    value, cached = cache_get_or_compute(
+        cache_key, RECOMMEND_TTL,
+        lambda: compute_recommendations(snap, events, k, filter_category, min_price, max_price,
+                                        nprobe, ef_search, profile),
+        ttl_of=recommend_ttl,
+    )
+    if value is None:
+        return {"cached": False, "results": []}
+    compact, partial = split_partial(value)
+    return with_partial({"cached": cached, "results": hydrate_results(snap, compact)}, partial)
+
+
+def recommend_batch_for_events(reqs: List[RecommendRequest], events_per_req: List[List[dict]],
+                               profiles: Optional[List[Optional[dict]]] = None):
+    responses = [None] * len(reqs)
+    pending = []  # (position, request, cache_key, user_vec)
+    snap = SNAPSHOT
+    profiles = profiles or [None] * len(reqs)
+
+    keyed = []  # (position, request, events, profile, cache_key)
+    for pos, (req, events, profile) in enumerate(zip(reqs, events_per_req, profiles)):
+        if req.filter_category and not has_category_activity(snap, events, req.filter_category, profile):
+            responses[pos] = {"user_id": req.user_id, "cached": False, "results": []}
+            continue
+        cache_key = recommend_cache_key(snap, req.user_id, events, req.filter_category,
+                                        req.min_price, req.max_price, req.k,
+                                        req.nprobe, req.ef_search, profile)
+        keyed.append((pos, req, events, profile, cache_key))
+
+    # All cache lookups of the batch in one MGET
+    cached_values = cache_get_many([entry[-1] for entry in keyed], RECOMMEND_TTL)
+    for (pos, req, events, profile, cache_key), cached in zip(keyed, cached_values):
+        # An empty result list is a hit too
+        if cached is not None:
+            compact, partial = split_partial(cached)
+            responses[pos] = with_partial(
+                {"user_id": req.user_id, "cached": True, "results": hydrate_results(snap, compact)}, partial)
+            continue
+
+        if snap.loaded and is_cold_start(events, profile) and snap.cold_order is not None:
+            # No search needed: served from the precomputed cold-start ordering
+            compact = compute_recommendations(snap, events, req.k, req.filter_category,
+                                              req.min_price, req.max_price)
+            cache_set(cache_key, compact, RECOMMEND_TTL)
+            responses[pos] = {"user_id": req.user_id, "cached": False, "results": hydrate_results(snap, compact)}
+            continue
+
+        user_vec = session_vector(snap, events, profile) if snap.loaded else None
+        if user_vec is None:
+            responses[pos] = {"user_id": req.user_id, "cached": False, "results": []}
+            continue
+        pending.append((pos, req, cache_key, user_vec))
+
+    # One search per distinct filter/ANN-knob combination (a single one when unfiltered)
+    groups = {}
+    for entry in pending:
+        req = entry[1]
+        key = (req.filter_category, req.min_price, req.max_price, req.nprobe, req.ef_search)
+        groups.setdefault(key, []).append(entry)
+
+    for (filter_category, min_price, max_price, nprobe, ef_search), group in groups.items():
+        queries = np.vstack([user_vec for _, _, _, user_vec in group])
+        top_k = max(candidate_pool_size(req.k) for _, req, _, _ in group)
+        try:
+            D, I, complete = filtered_search(snap, queries, top_k, (filter_category, min_price, max_price),
+                                             nprobe, ef_search)
+        except Exception:
+            D, I, complete = None, None, False
+
+        for row, (pos, req, cache_key, _) in enumerate(group):
+            if D is None:
+                responses[pos] = {"user_id": req.user_id, "cached": False, "results": []}
+                continue
+            # Only consider as many neighbours as a single /recommend call would
+            n = candidate_pool_size(req.k)
+            chosen = rank_candidates(snap, D[row, :n].tolist(), I[row, :n].tolist(), req.k,
+                                     req.filter_category, req.min_price, req.max_price)
+            value = cache_form(compact_results(chosen), complete)
+            cache_set(cache_key, value, recommend_ttl(value))
+            responses[pos] = with_partial({"user_id": req.user_id, "cached": False, "results": chosen}, not complete)
+
+    return responses
+
+
+@app.get("/recommend")
+async def recommend(
+    user_id: str = Query(...),
+    k: int = TOP_K_DEFAULT,
+    filter_category: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    nprobe: Optional[int] = Query(None, ge=1),
+    ef_search: Optional[int] = Query(None, ge=1),
+):
+    with timed("profile_read"):
+        profile = usable_profile(SNAPSHOT, await run_in_threadpool(read_profile, user_id))
+    # fetch real user events, unless the incremental profile already covers them
+    events = [] if profile is not None else await fetch_events_or_502(user_id)
+    return await run_in_threadpool(
+        recommend_for_events, user_id, events, k, filter_category, min_price, max_price,
+        nprobe, ef_search, profile
+    )
+
+
+@app.post("/recommend_batch")
+async def recommend_batch(body: RecommendBatchRequest):
+    """
+    Recommend for many users at once. User vectors are stacked into one
+    matrix and searched with a single FAISS call; filtering and scoring
+    are then applied per row. Results keep the order of `requests`.
+    """
+    if len(body.requests) > MAX_BATCH_USERS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_USERS} requests per batch")
 
-    # No fallback when filters are strict; we keep only filtered candidates
+    snap = SNAPSHOT
+    with timed("profile_read"):
+        profiles = await run_in_threadpool(read_profiles, [req.user_id for req in body.requests])
+    profiles = [usable_profile(snap, profile) for profile in profiles]
 
-    set_json(cache_key, chosen, ex=RECOMMEND_TTL)
-    return {"cached": False, "results": chosen}
+    # Event fetches (users without a profile) run concurrently, bounded by the Node client semaphore
+    async def events_for(req, profile):
+        return [] if profile is not None else await fetch_events(req.user_id)
+
+    fetched = await asyncio.gather(
+        *(events_for(req, profile) for req, profile in zip(body.requests, profiles)), return_exceptions=True
+    )
+    # A user whose events could not be fetched gets an error entry (as /recommend
+    # would answer 502), not cold-start results that look like a real answer
+    results = [None] * len(body.requests)
+    ok = []
+    for pos, (req, events) in enumerate(zip(body.requests, fetched)):
+        if isinstance(events, Exception):
+            print("Event fetch error:", events)
+            results[pos] = {"user_id": req.user_id, "error": "Could not fetch user events"}
+        else:
+            ok.append(pos)
+
+    responses = await run_in_threadpool(
+        recommend_batch_for_events, [body.requests[pos] for pos in ok],
+        [fetched[pos] for pos in ok], [profiles[pos] for pos in ok],
+    )
+    for pos, response in zip(ok, responses):
+        results[pos] = response
+    return {"results": results}
 
 
 # ---------------- EXPLAIN ----------------
+def explain_cache_key(user_id: str, product_id: str, evhash: str) -> str:
+    return f"explain:{user_id}:{product_id}:{evhash}"
+
+
+def explain_for_events(user_id: str, product_id: str, events: List[dict],
+                       filter_category: Optional[str] = None,
+                       min_price: Optional[float] = None,
+                       max_price: Optional[float] = None):
+    product = SNAPSHOT.product_lookup[product_id]
+
+    cache_key = explain_cache_key(user_id, product_id, events_hash(events))
+
+    # One LLM call per key even when many requests miss at once
+    resp, cached = cache_get_or_compute(
+        cache_key, EXPLAIN_TTL,
+        lambda: call_openai_explain(user_id, product, events, filter_category, min_price, max_price),
+        # Template fallbacks after an LLM error are not cached, as in /explain_batch
+        compress=True, store=lambda resp: "error" not in resp,
+    )
+    return {"cached": cached, "explanation": resp}
+
+
 @app.get("/explain")
-def explain(
+async def explain(
     user_id: str = Query(...),
     product_id: str = Query(...),
     filter_category: Optional[str] = None,
     min_price: Optional[float] = None,
     max_price: Optional[float] = None
 ):
-    if product_id not in product_lookup:
+    if product_id not in SNAPSHOT.product_lookup:
         raise HTTPException(404, "Product not found")
 
-    product = product_lookup[product_id]
-
     # get session events
-    summary = requests.get(f"{NODE_BACKEND}/api/events/{user_id}").json()
-    events = summary.get("recent_events", [])
+    events = await fetch_events_or_502(user_id)
 
-    evhash = events_hash(events)
-    cache_key = f"explain:{user_id}:{product_id}:{evhash}"
+    return await run_in_threadpool(
+        explain_for_events, user_id, product_id, events, filter_category, min_price, max_price
+    )
+
+
+MAX_EXPLAIN_BATCH = int(os.getenv("MAX_EXPLAIN_BATCH", "50"))
 
-    cached = get_json(cache_key)
-    if cached:
-        return {"cached": True, "explanation": cached}
 
-    resp = call_openai_explain(user_id, product, events, filter_category, min_price, max_price)
+class ExplainBatchRequest(BaseModel):
+    user_id: str
+    product_ids: List[str]
+    filter_category: Optional[str] = None
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
 
-    set_json(cache_key, resp, ex=EXPLAIN_TTL)
 
-    return {"cached": False, "explanation": resp}
+@app.post("/explain_batch")
+async def explain_batch(body: ExplainBatchRequest):
+    """
+    Explanations for several products of one user (e.g. a recommendation
+    carousel). Cache misses are explained concurrently; anything without an
+    LLM answer by EXPLAIN_BATCH_DEADLINE gets the template explanation.
+    Results keep the order of `product_ids`; unknown products get null.
+    """
+    if len(body.product_ids) > MAX_EXPLAIN_BATCH:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_EXPLAIN_BATCH} products per batch")
+
+    snap = SNAPSHOT
+    events = await fetch_events_or_502(body.user_id)
+    evhash = events_hash(events)
+    known = [pid for pid in body.product_ids if pid in snap.product_lookup]
+    keys = [explain_cache_key(body.user_id, pid, evhash) for pid in known]
+    cached = await run_in_threadpool(cache_get_many, keys, EXPLAIN_TTL)
+
+    explanations = {}
+    tasks = {}
+    for pid, key, value in zip(known, keys, cached):
+        if value is not None:
+            explanations[pid] = {"cached": True, "explanation": value}
+        elif pid not in tasks:
+            # Shared with concurrent requests for the same key (any worker);
+            # failed calls and timeouts are not cached, so the next request retries
+            tasks[pid] = asyncio.ensure_future(cache_compute_async(
+                key, EXPLAIN_TTL,
+                lambda pid=pid: call_openai_explain_async(
+                    body.user_id, snap.product_lookup[pid], events,
+                    body.filter_category, body.min_price, body.max_price,
+                ),
+                compress=True, store=lambda resp: "error" not in resp,
+            ))
+
+    if tasks:
+        # A late call keeps running and fills the cache for the next request
+        _, late = await asyncio.wait(tasks.values(), timeout=EXPLAIN_BATCH_DEADLINE)
+        for task in late:
+            task.cancel()
+
+    for pid, task in tasks.items():
+        if task.done() and not task.cancelled():
+            resp, was_cached = task.result()
+        else:
+            resp = {"text": template_explain(body.user_id, snap.product_lookup[pid], events),
+                    "source": "template", "error": "deadline exceeded"}
+            was_cached = False
+            LLM_CALLS.inc(outcome="deadline")
+        explanations[pid] = {"cached": was_cached, "explanation": resp}
+
+    return {
+        "results": [
+            {"product_id": pid, **explanations.get(pid, {"cached": False, "explanation": None})}
+            for pid in body.product_ids
+        ]
+    }
 
 
 # ---------------- SERVER START ----------------
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run("main:app", host="0.0.0.0", port=port)
+    # The app object, not "main:app": by name uvicorn would import this file a
+    # second time and load the snapshot again. Several workers: serve.py
+    uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,385 @@
+"""
+In-process counters and histograms rendered in the Prometheus text format
+(GET /metrics). Each process keeps its own values. When several workers share
+one listening socket (serve.py, `uvicorn --workers`) a scrape reaches a random
+worker, so set METRICS_DIR: every worker then writes its values there every
+METRICS_FLUSH_SECONDS and /metrics renders the sum over all workers. An
+exiting worker folds its values into one file of exited totals (serve.py does
+it for crashed ones when reaping them), so counters never go backwards on a
+restart and the directory holds one file per live worker. serve.py sets it
+up itself; with `uvicorn --workers`, point it at an empty directory.
+
+Stage timers also feed an optional per-request breakdown: after
+start_request_timing(), every stage recorded in that request's context
+(including threadpool work, which inherits the context) is added to the
+returned dict, which RequestMetricsMiddleware turns into a Server-Timing
+header.
+"""
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+# Seconds; covers sub-millisecond cache hits up to slow LLM calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Candidate counts per ranked row
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+# Shared directory for multi-worker aggregation; unset = this process only
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "1"))
+
+_registry = []
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple, extra=()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {key: self._snapshot(value) for key, value in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self, values: Optional[dict] = None):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        if values is None:
+            values = self.snapshot()
+        for key, value in sorted(values.items()):
+            yield from self._samples(key, value)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _snapshot(self, value):
+        return value
+
+    def _merge(self, a, b):
+        return a + b
+
+    def _samples(self, key, value):
+        yield f"{self.name}{self._labels(key)} {_fmt(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        slot = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][slot] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _snapshot(self, value):
+        return list(value[0]), value[1], value[2]
+
+    def _merge(self, a, b):
+        return [x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]
+
+    def _samples(self, key, value):
+        counts, total, n = value
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield f"{self.name}_bucket{self._labels(key, [('le', _fmt(bound))])} {cumulative}"
+        yield f"{self.name}_sum{self._labels(key)} {_fmt(total)}"
+        yield f"{self.name}_count{self._labels(key)} {n}"
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format;
+    summed over every worker's file in METRICS_DIR when sharing is on."""
+    merged = _merged_values() if _flusher is not None else {}
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render(merged.get(metric.name)))
+    return "\n".join(lines) + "\n"
+
+
+# ----------------------------------------------------
+# MULTI-WORKER AGGREGATION
+# ----------------------------------------------------
+_flusher: Optional[threading.Thread] = None
+_flusher_stop = threading.Event()
+
+# Totals of exited workers, folded together so the directory holds one file
+# per live worker plus this one
+EXITED_FILE = "exited.json"
+
+
+def _pid_file(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+
+@contextmanager
+def _dir_lock(exclusive: bool):
+    """flock on METRICS_DIR/.lock: folding a worker's file into the exited
+    totals (exclusive) never interleaves with a scrape reading them (shared)."""
+    import fcntl
+
+    with open(os.path.join(METRICS_DIR, ".lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _dump(data: dict, path: str):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _load(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _serialize(merged: dict) -> dict:
+    return {name: [[list(key), value] for key, value in values.items()] for name, values in merged.items()}
+
+
+def _merge_into(merged: dict, data: dict):
+    """Add a file's values ({name: [[key, value], ...]}) into `merged`
+    ({name: {key tuple: value}})."""
+    by_name = {metric.name: metric for metric in _registry}
+    for metric_name, entries in data.items():
+        metric = by_name.get(metric_name)
+        if metric is None:
+            continue
+        values = merged.setdefault(metric_name, {})
+        for key, value in entries:
+            key = tuple(key)
+            values[key] = value if key not in values else metric._merge(values[key], value)
+
+
+def _flush():
+    """Write this process's values to METRICS_DIR (atomically replaced)."""
+    _dump(_serialize({metric.name: metric.snapshot() for metric in _registry}), _pid_file(os.getpid()))
+
+
+def fold_exited(pid: int):
+    """Add the last values of exited worker `pid` to the exited totals and
+    remove its file. Called by the worker on shutdown and by serve.py when it
+    reaps one (covering workers that crashed); a no-op when there is no file."""
+    if not METRICS_DIR:
+        return
+    path = _pid_file(pid)
+    try:
+        with _dir_lock(exclusive=True):
+            data = _load(path)
+            if data is None:
+                return
+            totals = {}
+            _merge_into(totals, _load(os.path.join(METRICS_DIR, EXITED_FILE)) or {})
+            _merge_into(totals, data)
+            _dump(_serialize(totals), os.path.join(METRICS_DIR, EXITED_FILE))
+            os.remove(path)
+    except OSError as e:
+        print("[recommender] Metrics fold error:", e)
+
+
+def _merged_values() -> dict:
+    """metric name -> {label key: value}: this process's live values plus
+    the last flush of every other worker and the exited totals."""
+    merged = {metric.name: metric.snapshot() for metric in _registry}
+    own = os.path.basename(_pid_file(os.getpid()))
+    try:
+        with _dir_lock(exclusive=False):
+            for name in os.listdir(METRICS_DIR):
+                if name.endswith(".json") and name != own:
+                    _merge_into(merged, _load(os.path.join(METRICS_DIR, name)) or {})
+    except OSError as e:
+        print("[recommender] Metrics dir error:", e)
+    return merged
+
+
+def start_sharing():
+    """Start flushing this worker's values to METRICS_DIR (no-op when unset).
+    Values inherited from a parent process are dropped first, so a forked
+    worker does not count the parent's again."""
+    global _flusher
+    if not METRICS_DIR or _flusher is not None:
+        return
+    for metric in _registry:
+        metric.reset()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    # A file under this pid belongs to an earlier worker that was never folded
+    fold_exited(os.getpid())
+
+    def run():
+        while not _flusher_stop.wait(METRICS_FLUSH_SECONDS):
+            try:
+                _flush()
+            except OSError as e:
+                print("[recommender] Metrics flush error:", e)
+
+    _flusher_stop.clear()
+    _flusher = threading.Thread(target=run, name="metrics-flush", daemon=True)
+    _flusher.start()
+
+
+def stop_sharing():
+    """Stop the flusher and fold the final values into the exited totals."""
+    global _flusher
+    if _flusher is None:
+        return
+    _flusher_stop.set()
+    _flusher.join()
+    _flusher = None
+    try:
+        _flush()
+    except OSError as e:
+        print("[recommender] Metrics flush error:", e)
+        return
+    fold_exited(os.getpid())
+
+
+# ----------------------------------------------------
+# SERVICE METRICS
+# ----------------------------------------------------
+STAGE_SECONDS = Histogram(
+    "recommender_stage_seconds", "Time spent per pipeline stage.", ["stage"])
+HTTP_SECONDS = Histogram(
+    "recommender_http_request_seconds", "Request latency by route.", ["method", "route", "status"])
+CACHE_REQUESTS = Counter(
+    "recommender_cache_requests_total", "Result cache lookups by cache and outcome.", ["cache", "result"])
+CANDIDATES = Histogram(
+    "recommender_candidates", "Candidates per ranked row, as retrieved and as kept after filters.",
+    ["stage"], buckets=COUNT_BUCKETS)
+LLM_SECONDS = Histogram(
+    "recommender_llm_call_seconds", "Latency of LLM explanation calls.", ["mode"])
+LLM_CALLS = Counter(
+    "recommender_llm_calls_total", "Explanations by outcome (openai, or a template fallback: "
+    "error, deadline, disabled).", ["outcome"])
+
+
+# ----------------------------------------------------
+# PER-REQUEST TIMING
+# ----------------------------------------------------
+_request_timings: ContextVar[Optional[dict]] = ContextVar("request_timings", default=None)
+
+
+def start_request_timing() -> dict:
+    """Collect the stages of the current request into the returned dict."""
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def record_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - t0)
+
+
+def server_timing(timings: dict) -> str:
+    """Server-Timing header value (durations in ms); stages that ran several
+    times in one request (batch endpoints) are summed."""
+    return ", ".join(f"{stage};dur={seconds * 1000.0:.2f}" for stage, seconds in timings.items())
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware recording request latency per route template and, for
+    requests carrying `timing_header` (any value but "0"), adding a
+    Server-Timing header with the stage breakdown.
+    """
+
+    def __init__(self, app, timing_header: str = "X-Timing"):
+        self.app = app
+        self.timing_header = timing_header.lower().encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        want_timing = dict(scope["headers"]).get(self.timing_header, b"0") != b"0"
+        # Set before calling the app so the handler (and its threadpool calls) inherit it
+        timings = start_request_timing()
+        t0 = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if want_timing:
+                    timings["total"] = time.perf_counter() - t0
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing(timings).encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Route templates, not raw paths, keep the label set bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_SECONDS.observe(time.perf_counter() - t0, method=scope["method"], route=route, status=status)
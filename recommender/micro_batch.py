@@ -0,0 +1,116 @@
+import time
+import threading
+from typing import Callable, List
+
+from metrics import Histogram, record_stage
+
+BATCH_SIZES = Histogram(
+    "recommender_micro_batch_size", "Items per micro-batch.", ["batcher"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+class _Slot:
+    __slots__ = ("item", "result", "done", "promoted", "enqueued", "started")
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.done = threading.Event()
+        self.promoted = False
+        self.enqueued = time.perf_counter()
+        self.started = self.enqueued
+
+
+class MicroBatcher:
+    """
+    Groups blocking calls from concurrent threads into batches: items passed
+    to submit() within `max_wait` seconds of the first one (or until
+    `max_batch` are queued) are handed to `process(items)` in one call, which
+    must return one result per item. A result that is an exception is raised
+    in its submitter only.
+
+    At most `max_inflight` batches run at a time; while they do, the next
+    batch keeps filling, so batches grow with load instead of splitting the
+    CPU between many small ones. There is no background thread: the first
+    submitter of a batch waits for it to be ready and runs it, so a request
+    is delayed by at most `max_wait` plus the running batches.
+    `max_wait <= 0` calls `process` directly.
+    """
+
+    def __init__(self, process: Callable[[List], List], max_batch: int = 64,
+                 max_wait: float = 0.002, max_inflight: int = 1, name: str = "batch"):
+        self.process = process
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.max_inflight = max(1, max_inflight)
+        self.name = name
+        self._pending: List[_Slot] = []
+        self._leader = None
+        self._running = 0
+        self._cond = threading.Condition()
+
+    def submit(self, item):
+        if self.max_wait <= 0:
+            return self._unwrap(self.process([item])[0])
+
+        slot = _Slot(item)
+        with self._cond:
+            self._pending.append(slot)
+            lead = self._leader is None
+            if lead:
+                self._leader = slot
+            elif len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+
+        if not lead:
+            slot.done.wait()
+            lead = slot.promoted
+        if lead:
+            # Leads the next batch, which includes this slot
+            self._lead()
+        record_stage(f"{self.name}_wait", slot.started - slot.enqueued)
+        return self._unwrap(slot.result)
+
+    def _lead(self):
+        deadline = time.perf_counter() + self.max_wait
+        with self._cond:
+            while True:
+                full = len(self._pending) >= self.max_batch
+                remaining = deadline - time.perf_counter()
+                if self._running < self.max_inflight and (full or remaining <= 0):
+                    break
+                # Past the window (or full): wait for a running batch to finish
+                self._cond.wait(remaining if remaining > 0 and not full else None)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            self._running += 1
+            # Overflow starts its own window under the oldest waiting slot
+            self._leader = self._pending[0] if self._pending else None
+            if self._leader is not None:
+                self._leader.promoted = True
+                self._leader.done.set()
+        try:
+            self._run(batch)
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+    def _run(self, batch: List[_Slot]):
+        started = time.perf_counter()
+        BATCH_SIZES.observe(len(batch), batcher=self.name)
+        try:
+            results = self.process([slot.item for slot in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for slot, result in zip(batch, results):
+            slot.started = started
+            slot.result = result
+            slot.promoted = False
+            slot.done.set()
+
+    @staticmethod
+    def _unwrap(result):
+        if isinstance(result, BaseException):
+            raise result
+        return result
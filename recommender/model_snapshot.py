@@ -0,0 +1,383 @@
+import os
+import shutil
+import time
+import uuid
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+import faiss
+from dotenv import load_dotenv
+
+from utils import dequantize, load_catalog, load_embeddings
+from vector_index import INDEX_TYPE, configure_blas, create_index, read_index
+
+load_dotenv()
+
+# Legacy single-copy artifact locations (used until the first versioned build)
+EMBEDDINGS_PATH = os.getenv("EMBEDDINGS_PATH", "./embeddings.npy")
+FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "./faiss_index.bin")
+PRODUCT_IDS_PATH = os.getenv("PRODUCT_IDS_PATH", "./product_ids.json")
+PRODUCTS_CSV = os.getenv("PRODUCTS_CSV", "../data/products_curated_v3_with_brands.csv")
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", "./catalog.pkl")
+INDEX_REPORT_PATH = os.getenv("INDEX_REPORT_PATH", "./index_report.json")
+FAISS_IDS_PATH = os.getenv("FAISS_IDS_PATH", "./faiss_ids.npy")
+BUILD_STATE_PATH = os.getenv("BUILD_STATE_PATH", "./build_state.json")
+EMBEDDINGS_MMAP = os.getenv("EMBEDDINGS_MMAP", "1") == "1"
+NEIGHBORS_PATH = os.getenv("NEIGHBORS_PATH", "./neighbors.npy")
+NEIGHBOR_SCORES_PATH = os.getenv("NEIGHBOR_SCORES_PATH", "./neighbor_scores.npy")
+# Quantized (float16 / int8) copy served instead of EMBEDDINGS_PATH when present
+EMBEDDINGS_Q_PATH = os.getenv("EMBEDDINGS_Q_PATH", os.path.splitext(EMBEDDINGS_PATH)[0] + "_q.npy")
+# Per-shard indexes of a sharded build (INDEX_SHARDS), one shard-<i>/ each
+SHARDS_DIR = os.getenv("SHARDS_DIR", "./shards")
+EMBEDDINGS_SCALE_PATH = os.getenv("EMBEDDINGS_SCALE_PATH", os.path.splitext(EMBEDDINGS_PATH)[0] + "_scale.npy")
+
+# Versioned builds: ARTIFACTS_DIR/<version>/..., ARTIFACTS_DIR/CURRENT names the live one
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR", "./artifacts")
+KEEP_VERSIONS = int(os.getenv("KEEP_VERSIONS", "3"))
+CURRENT_POINTER = "CURRENT"
+LEGACY_VERSION = "legacy"
+
+
+@dataclass(frozen=True)
+class ModelSnapshot:
+    """
+    Everything a request needs to serve from one consistent build: catalog,
+    embeddings, index, ids and the row-aligned catalog columns. Never mutated;
+    a rebuild produces a new snapshot that replaces the old one in one
+    reference assignment.
+    """
+    version: str
+    products_df: pd.DataFrame
+    product_lookup: Mapping
+    embeddings: Optional[np.ndarray]
+    index: object
+    product_ids: List[str]
+    product_index: dict
+    # Catalog columns aligned with product_ids rows, used for vectorized filtering
+    in_lookup: np.ndarray
+    prices: np.ndarray
+    category_codes: np.ndarray
+    category_vocab: dict
+    # Index id per row when the index stores explicit ids (incremental builds);
+    # None when ids are simply row numbers
+    faiss_ids: Optional[np.ndarray] = None
+    id_order: Optional[np.ndarray] = None
+    sorted_ids: Optional[np.ndarray] = None
+    # Per-dimension scale when `embeddings` holds int8 codes
+    embeddings_scale: Optional[np.ndarray] = None
+    # Precomputed item-to-item table: similar rows / scores per row (-1 = none)
+    neighbors: Optional[np.ndarray] = None
+    neighbor_scores: Optional[np.ndarray] = None
+    # Cold start: normalized catalog centroid (1, d), every row ordered by
+    # similarity to it, and that similarity per row
+    centroid: Optional[np.ndarray] = None
+    cold_order: Optional[np.ndarray] = None
+    cold_scores: Optional[np.ndarray] = None
+    # Searched through shard servers instead of `index` (which is then None)
+    sharded: bool = False
+
+    @property
+    def loaded(self) -> bool:
+        return (self.index is not None or self.sharded) and self.embeddings is not None and len(self.product_ids) > 0
+
+    def vectors(self, rows) -> np.ndarray:
+        """float32 embedding rows, dequantized if stored as float16 / int8."""
+        return dequantize(self.embeddings[rows], self.embeddings_scale)
+
+    def rows_for_ids(self, ids: np.ndarray) -> np.ndarray:
+        """Translate ids returned by the index into embedding rows (-1 if unknown)."""
+        if self.faiss_ids is None:
+            return ids
+        pos = np.clip(np.searchsorted(self.sorted_ids, ids), 0, len(self.sorted_ids) - 1)
+        found = (ids >= 0) & (self.sorted_ids[pos] == ids)
+        return np.where(found, self.id_order[pos], -1)
+
+    def id_mask(self, rows_mask: np.ndarray) -> np.ndarray:
+        """Boolean mask over index ids equivalent to a boolean mask over rows."""
+        if self.faiss_ids is None:
+            return rows_mask
+        mask = np.zeros(int(self.sorted_ids[-1]) + 1, dtype=bool)
+        mask[self.faiss_ids[rows_mask]] = True
+        return mask
+
+
+def artifact_paths(version_dir: Optional[str] = None) -> dict:
+    """Artifact file locations for a version directory, or the legacy env paths."""
+    if version_dir is None:
+        return {
+            "embeddings": EMBEDDINGS_PATH,
+            "product_ids": PRODUCT_IDS_PATH,
+            "faiss_index": FAISS_INDEX_PATH,
+            "catalog": CATALOG_SNAPSHOT_PATH,
+            "report": INDEX_REPORT_PATH,
+            "faiss_ids": FAISS_IDS_PATH,
+            "build_state": BUILD_STATE_PATH,
+            "embeddings_q": EMBEDDINGS_Q_PATH,
+            "embeddings_scale": EMBEDDINGS_SCALE_PATH,
+            "neighbors": NEIGHBORS_PATH,
+            "neighbor_scores": NEIGHBOR_SCORES_PATH,
+            "shards": SHARDS_DIR,
+        }
+    return {
+        "embeddings": os.path.join(version_dir, "embeddings.npy"),
+        "product_ids": os.path.join(version_dir, "product_ids.json"),
+        "faiss_index": os.path.join(version_dir, "faiss_index.bin"),
+        "catalog": os.path.join(version_dir, "catalog.pkl"),
+        "report": os.path.join(version_dir, "index_report.json"),
+        "faiss_ids": os.path.join(version_dir, "faiss_ids.npy"),
+        "build_state": os.path.join(version_dir, "build_state.json"),
+        "embeddings_q": os.path.join(version_dir, "embeddings_q.npy"),
+        "embeddings_scale": os.path.join(version_dir, "embeddings_scale.npy"),
+        "neighbors": os.path.join(version_dir, "neighbors.npy"),
+        "neighbor_scores": os.path.join(version_dir, "neighbor_scores.npy"),
+        "shards": os.path.join(version_dir, "shards"),
+    }
+
+
+def shard_paths(shards_dir: str, shard: int) -> dict:
+    shard_dir = os.path.join(shards_dir, f"shard-{shard}")
+    return {
+        "dir": shard_dir,
+        "faiss_index": os.path.join(shard_dir, "faiss_index.bin"),
+        # Index id and catalog filter columns per shard row
+        "columns": os.path.join(shard_dir, "columns.npz"),
+        "manifest": os.path.join(shards_dir, "manifest.json"),
+    }
+
+
+def current_version(artifacts_dir: str = ARTIFACTS_DIR) -> str:
+    try:
+        with open(os.path.join(artifacts_dir, CURRENT_POINTER), "r") as f:
+            return f.read().strip() or LEGACY_VERSION
+    except FileNotFoundError:
+        return LEGACY_VERSION
+
+
+def new_version_dir(artifacts_dir: str = ARTIFACTS_DIR):
+    version = time.strftime("v%Y%m%d%H%M%S") + "-" + uuid.uuid4().hex[:6]
+    path = os.path.join(artifacts_dir, version)
+    os.makedirs(path)
+    return version, path
+
+
+def publish_version(version: str, artifacts_dir: str = ARTIFACTS_DIR):
+    """Atomically point CURRENT at `version` and prune old version dirs."""
+    tmp = os.path.join(artifacts_dir, f".{CURRENT_POINTER}.{uuid.uuid4().hex}")
+    with open(tmp, "w") as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(artifacts_dir, CURRENT_POINTER))
+
+    versions = sorted(
+        d for d in os.listdir(artifacts_dir)
+        if d.startswith("v") and os.path.isdir(os.path.join(artifacts_dir, d))
+    )
+    # Mapped files stay valid for workers still serving an older version
+    for old in versions[:-KEEP_VERSIONS]:
+        if old != version:
+            shutil.rmtree(os.path.join(artifacts_dir, old), ignore_errors=True)
+
+
+class CatalogLookup(Mapping):
+    """
+    product_id -> catalog row dict, as dict(zip(ids, df.to_dict("records")))
+    would give, but each dict is built on access from per-column lists:
+    loading skips one dict per product (the bulk of startup on large
+    catalogs) and the snapshot holds far fewer objects. Returns a fresh dict
+    per lookup.
+    """
+
+    def __init__(self, products_df: pd.DataFrame):
+        self._columns = {col: products_df[col].tolist() for col in products_df.columns}
+        self._rows = dict(zip(products_df["product_id"].astype(str).tolist(), range(len(products_df))))
+
+    def __getitem__(self, product_id) -> dict:
+        row = self._rows[product_id]
+        return {col: values[row] for col, values in self._columns.items()}
+
+    def __contains__(self, product_id) -> bool:
+        return product_id in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+
+def build_product_index(product_ids: List[str]) -> dict:
+    """Map product_id -> embedding row so event lookups are O(1)."""
+    return {str(pid): i for i, pid in enumerate(product_ids)}
+
+
+def build_catalog_arrays(products_df: pd.DataFrame, product_ids: List[str]):
+    """
+    Price and normalized category per embedding row. Categories are stored
+    as integer codes (-1 when missing); rows without catalog metadata are
+    flagged out via the returned `in_lookup` mask.
+    """
+    df = products_df.drop_duplicates("product_id", keep="last").set_index("product_id")
+    aligned = df.reindex([str(pid) for pid in product_ids])
+
+    in_lookup = aligned.index.isin(df.index)
+    prices = pd.to_numeric(aligned["price"], errors="coerce").to_numpy(dtype="float64")
+
+    codes, uniques = pd.factorize(aligned["normalized_top_category"])
+    category_vocab = {str(name): i for i, name in enumerate(uniques)}
+    return in_lookup, prices, codes.astype("int32"), category_vocab
+
+
+def catalog_mask(in_lookup: np.ndarray, prices: np.ndarray, category_codes: np.ndarray, category_vocab: dict,
+                 filter_category: Optional[str] = None,
+                 min_price: Optional[float] = None,
+                 max_price: Optional[float] = None) -> np.ndarray:
+    """Strict category / price filter over row-aligned catalog columns."""
+    mask = np.array(in_lookup, dtype=bool)
+    if min_price is not None:
+        mask &= ~(prices < float(min_price))
+    if max_price is not None:
+        mask &= ~(prices > float(max_price))
+    if filter_category:
+        mask &= category_codes == category_vocab.get(filter_category, -2)
+    return mask
+
+
+def cold_start_ranking(embeddings: np.ndarray, scale: Optional[np.ndarray] = None, chunk_size: int = 50000):
+    """
+    Normalized mean embedding (NaNs ignored) and all rows ranked by cosine
+    similarity to it. Computed once per snapshot so users without activity
+    never touch the full matrix at request time.
+    """
+    def block_at(start):
+        block = embeddings[start:start + chunk_size]
+        if scale is None and block.dtype == np.float32:
+            return np.asarray(block)
+        return dequantize(block, scale)
+
+    n, d = embeddings.shape
+    total = np.zeros(d, dtype="float64")
+    count = np.zeros(d, dtype="float64")
+    for start in range(0, n, chunk_size):
+        block = block_at(start)
+        part = block.sum(axis=0, dtype="float64")
+        if np.isfinite(part).all():
+            total += part
+            count += len(block)
+        else:
+            total += np.nansum(block, axis=0, dtype="float64")
+            count += np.sum(~np.isnan(block), axis=0)
+    centroid = np.where(count > 0, total / np.maximum(count, 1), 0.0).astype("float32").reshape(1, -1)
+    faiss.normalize_L2(centroid)
+
+    scores = np.empty(n, dtype="float32")
+    for start in range(0, n, chunk_size):
+        block = block_at(start)
+        # Cosine, like the index (legacy embeddings files may be unnormalized)
+        norms = np.sqrt(np.einsum("ij,ij->i", block, block))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sims = (block @ centroid[0]) / norms
+        scores[start:start + len(block)] = np.where(np.isfinite(sims), sims, -np.inf)
+    order = np.argsort(-scores, kind="stable").astype("int32" if n < 2**31 else "int64")
+    return centroid, order, scores
+
+
+def load_snapshot(artifacts_dir: str = ARTIFACTS_DIR, load_index: bool = True) -> ModelSnapshot:
+    """Load the version named by CURRENT, falling back to the legacy paths.
+    Without `load_index` the snapshot is for a sharded front end: the index
+    stays with the shard servers."""
+    started = time.perf_counter()
+    timings = {}
+
+    def lap(stage):
+        timings[stage] = time.perf_counter() - started - sum(timings.values())
+
+    version = current_version(artifacts_dir)
+    paths = artifact_paths(None if version == LEGACY_VERSION else os.path.join(artifacts_dir, version))
+
+    products_df = load_catalog(PRODUCTS_CSV, paths["catalog"])
+    lap("catalog")
+    product_lookup = CatalogLookup(products_df)
+    lap("lookup")
+
+    embeddings = None
+    index = None
+    product_ids = []
+    faiss_ids = None
+    scale = None
+    # The float32 file stays the build master; a quantized copy is served when built
+    emb_path = paths["embeddings_q"] if os.path.exists(paths["embeddings_q"]) else paths["embeddings"]
+    if os.path.exists(emb_path) and os.path.exists(paths["product_ids"]):
+        # Memory-mapped read-only: workers share the OS page cache instead of each
+        # holding a private copy
+        embeddings, product_ids = load_embeddings(emb_path, paths["product_ids"], mmap=EMBEDDINGS_MMAP)
+        if embeddings.dtype == np.int8:
+            scale = np.load(paths["embeddings_scale"])
+        lap("embeddings")
+        # Build or load FAISS index (a sharded front end only needs the ids)
+        if os.path.exists(paths["faiss_index"]) or not load_index:
+            index = read_index(paths["faiss_index"]) if load_index else None
+            if os.path.exists(paths["faiss_ids"]):
+                faiss_ids = np.load(paths["faiss_ids"])
+                if np.array_equal(faiss_ids, np.arange(len(faiss_ids))):
+                    faiss_ids = None
+        else:
+            try:
+                # Inner-product index for cosine similarity (with L2-normalized vectors)
+                vectors = dequantize(embeddings, scale)
+                faiss.normalize_L2(vectors)
+                index = create_index(vectors, INDEX_TYPE)
+                faiss.write_index(index, paths["faiss_index"])
+                print("[recommender] FAISS index built and saved:", paths["faiss_index"])
+            except Exception as e:
+                print("[recommender] Failed to build FAISS index:", e)
+                index = None
+
+    if index is not None:
+        configure_blas(index.d)
+    lap("index")
+
+    neighbors = None
+    neighbor_scores = None
+    if os.path.exists(paths["neighbors"]) and os.path.exists(paths["neighbor_scores"]):
+        neighbors = np.load(paths["neighbors"], mmap_mode="r" if EMBEDDINGS_MMAP else None)
+        neighbor_scores = np.load(paths["neighbor_scores"], mmap_mode="r" if EMBEDDINGS_MMAP else None)
+        if len(neighbors) != len(product_ids):
+            # Left over from a different build
+            neighbors = neighbor_scores = None
+    lap("neighbors")
+
+    centroid = cold_order = cold_scores = None
+    if embeddings is not None and len(product_ids):
+        centroid, cold_order, cold_scores = cold_start_ranking(embeddings, scale)
+    lap("cold_start")
+
+    in_lookup, prices, category_codes, category_vocab = build_catalog_arrays(products_df, product_ids)
+    id_order = None if faiss_ids is None else np.argsort(faiss_ids, kind="stable")
+    lap("columns")
+    print(f"[recommender] Loaded version {version} in {time.perf_counter() - started:.2f}s ("
+          + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items()) + ")")
+    return ModelSnapshot(
+        version=version,
+        products_df=products_df,
+        product_lookup=product_lookup,
+        embeddings=embeddings,
+        index=index,
+        product_ids=product_ids,
+        product_index=build_product_index(product_ids),
+        in_lookup=in_lookup,
+        prices=prices,
+        category_codes=category_codes,
+        category_vocab=category_vocab,
+        faiss_ids=faiss_ids,
+        id_order=id_order,
+        sorted_ids=None if faiss_ids is None else faiss_ids[id_order],
+        embeddings_scale=scale,
+        neighbors=neighbors,
+        neighbor_scores=neighbor_scores,
+        centroid=centroid,
+        cold_order=cold_order,
+        cold_scores=cold_scores,
+        sharded=not load_index,
+    )
@@ -0,0 +1,62 @@
+import os
+import time
+from typing import List
+
+import numpy as np
+import faiss
+from dotenv import load_dotenv
+
+from local_cache import LRUCache
+from metrics import CACHE_REQUESTS, timed
+from micro_batch import MicroBatcher
+from utils import MODEL_NAME, get_model
+
+load_dotenv()
+
+# Normalized query -> unit embedding, per worker
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "10000"))
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "86400"))
+# Concurrent queries within this window (or up to the max) are encoded as one batch
+ENCODE_BATCH_WAIT_MS = float(os.getenv("ENCODE_BATCH_WAIT_MS", "2"))
+ENCODE_BATCH_MAX = int(os.getenv("ENCODE_BATCH_MAX", "32"))
+
+_query_cache = LRUCache(QUERY_CACHE_SIZE)
+
+
+def normalize_query(q: str) -> str:
+    # MiniLM is uncased, so case and spacing variants share one embedding
+    return " ".join(q.lower().split())
+
+
+def encode_queries(texts: List[str]) -> List[np.ndarray]:
+    """Unit (1, d) float32 embeddings of `texts`, encoded in one model call."""
+    unique = list(dict.fromkeys(texts))
+    vectors = np.asarray(get_model(MODEL_NAME).encode(unique, batch_size=len(unique), show_progress_bar=False,
+                                                      convert_to_numpy=True), dtype="float32")
+    faiss.normalize_L2(vectors)
+    rows = {text: vectors[i:i + 1] for i, text in enumerate(unique)}
+    return [rows[text] for text in texts]
+
+
+encode_batcher = MicroBatcher(encode_queries, max_batch=ENCODE_BATCH_MAX,
+                              max_wait=ENCODE_BATCH_WAIT_MS / 1000.0, name="encode_batch")
+
+
+def embed_query(q: str) -> np.ndarray:
+    """Embedding of the normalized query `q`, from the cache or the encoder."""
+    vec = _query_cache.get(q)
+    if vec is not None:
+        CACHE_REQUESTS.inc(cache="query_embedding", result="local_hits")
+        return vec
+    CACHE_REQUESTS.inc(cache="query_embedding", result="misses")
+    with timed("query_encode"):
+        vec = encode_batcher.submit(q)
+    _query_cache.set(q, vec, QUERY_CACHE_TTL)
+    return vec
+
+
+def warm_encoder():
+    """Load the model and run one encode so the first /search is not slow."""
+    t0 = time.perf_counter()
+    encode_queries(["warm up"])
+    print(f"[recommender] Query encoder ready in {time.perf_counter() - t0:.1f}s")
@@ -1,5 +1,7 @@
 import os
 import json
+import zlib
+import msgpack
 from redis import Redis
 from dotenv import load_dotenv
 
@@ -7,11 +9,21 @@ load_dotenv()
 
 REDIS_URL = os.getenv("REDIS_URL")
 
+# Packed payloads below this size are stored uncompressed even when compression is requested
+CACHE_COMPRESS_MIN = int(os.getenv("CACHE_COMPRESS_MIN", "256"))
+
 redis_client = Redis.from_url(
     REDIS_URL,
     decode_responses=True
 )
 
+# Raw-bytes client for binary (msgpack) cache payloads
+redis_binary = Redis.from_url(REDIS_URL)
+
+# One-byte format tag in front of packed payloads
+_PACKED = b"m"
+_PACKED_ZLIB = b"z"
+
 def set_json(key: str, value, ex: int = None):
     redis_client.set(key, json.dumps(value, ensure_ascii=False), ex=ex)
 
@@ -23,3 +35,100 @@ def get_json(key: str):
         return json.loads(raw)
     except:
         return None
+
+def set_json_nx(key: str, value, ex: int = None) -> bool:
+    """Set only if the key does not exist (used as a simple distributed lock)."""
+    return bool(redis_client.set(key, json.dumps(value, ensure_ascii=False), ex=ex, nx=True))
+
+def delete_key(key: str):
+    redis_client.delete(key)
+
+# Deletes a lock only while it still holds the caller's token, so a holder that
+# ran past the TTL cannot release the lock another worker has taken since
+_release_lock = redis_client.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+)
+
+def acquire_lock(key: str, token: str, ex: int) -> bool:
+    """SET NX with `token` as the owner; release with release_lock."""
+    return bool(redis_client.set(key, token, ex=ex, nx=True))
+
+def release_lock(key: str, token: str) -> bool:
+    return bool(_release_lock(keys=[key], args=[token]))
+
+_extend_lock = redis_client.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end return 0"
+)
+
+def extend_lock(key: str, token: str, ex: int) -> bool:
+    """Reset the lock's TTL to `ex` while the caller still holds it."""
+    return bool(_extend_lock(keys=[key], args=[token, ex]))
+
+def lock_owner(key: str):
+    """Token of the lock's current holder, or None when it is free."""
+    return redis_client.get(key)
+
+def get_list_json(key: str, start: int = 0, end: int = -1):
+    """Read a Redis list of JSON entries. Returns None if the list is missing."""
+    raw = redis_client.lrange(key, start, end)
+    if not raw:
+        return None
+    items = []
+    for entry in raw:
+        try:
+            items.append(json.loads(entry))
+        except:
+            continue
+    return items
+
+def pack_value(value, compress: bool = False) -> bytes:
+    data = msgpack.packb(value, use_bin_type=True)
+    if compress and len(data) >= CACHE_COMPRESS_MIN:
+        return _PACKED_ZLIB + zlib.compress(data)
+    return _PACKED + data
+
+def unpack_value(raw: bytes):
+    if not raw:
+        return None
+    try:
+        tag, data = raw[:1], raw[1:]
+        if tag == _PACKED:
+            return msgpack.unpackb(data, raw=False)
+        if tag == _PACKED_ZLIB:
+            return msgpack.unpackb(zlib.decompress(data), raw=False)
+        # Entries written as JSON before the switch to msgpack
+        return json.loads(raw)
+    except:
+        return None
+
+def set_packed(key: str, value, ex: int = None, compress: bool = False):
+    redis_binary.set(key, pack_value(value, compress), ex=ex)
+
+def get_packed(key: str):
+    return unpack_value(redis_binary.get(key))
+
+def get_many_packed(keys):
+    """MGET several packed keys in one round-trip; None for missing/undecodable."""
+    if not keys:
+        return []
+    return [unpack_value(raw) for raw in redis_binary.mget(keys)]
+
+def get_packed_with_ttl(key: str):
+    """(value, remaining TTL in ms) in one round-trip. The TTL is -1 for keys
+    without an expiry and -2 for missing keys, as PTTL returns."""
+    pipe = redis_binary.pipeline(transaction=False)
+    pipe.get(key)
+    pipe.pttl(key)
+    raw, pttl = pipe.execute()
+    return unpack_value(raw), pttl
+
+def get_many_packed_with_ttl(keys):
+    """get_many_packed plus each key's remaining TTL (ms), in one round-trip."""
+    if not keys:
+        return []
+    pipe = redis_binary.pipeline(transaction=False)
+    pipe.mget(keys)
+    for key in keys:
+        pipe.pttl(key)
+    raw, *pttls = pipe.execute()
+    return [(unpack_value(value), pttl) for value, pttl in zip(raw, pttls)]
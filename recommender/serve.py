@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Pre-fork server for the recommender API. The catalog, embeddings and index
+are loaded once, here in the parent, which then forks WORKERS uvicorn
+workers accepting on one shared socket. Workers inherit the snapshot
+copy-on-write instead of each loading (and holding) their own, so they are
+ready in well under a second and memory stays flat as workers are added.
+With SEARCH_WARM_ENCODER on, the /search query encoder (torch and MiniLM) is
+loaded here once as well, rather than by every worker.
+
+    WORKERS=4 PORT=8000 python serve.py
+
+The parent also polls ARTIFACTS_DIR/CURRENT: on a new build it loads the
+snapshot once and replaces the workers, so the new build is shared as well.
+Workers that die are restarted; SIGHUP replaces all workers. /metrics sums
+all workers through METRICS_DIR (a fresh temporary directory by default).
+"""
+import time
+_STARTED = time.perf_counter()
+import os
+import gc
+import glob
+import signal
+import socket
+import tempfile
+
+import faiss
+import uvicorn
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WORKERS = int(os.getenv("WORKERS", "0")) or os.cpu_count() or 1
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+# Seconds a replaced worker gets to finish in-flight requests
+GRACEFUL_TIMEOUT = float(os.getenv("GRACEFUL_TIMEOUT", "30"))
+
+# A scrape lands on any one worker: workers share their metrics through a
+# directory (read by metrics.py at import), emptied here so totals start at 0
+if not os.getenv("METRICS_DIR"):
+    os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="recommender-metrics-")
+for stale in glob.glob(os.path.join(os.environ["METRICS_DIR"], "*.json")):
+    os.remove(stale)
+
+# libgomp's thread pool does not survive fork: a worker whose parent ever ran
+# an OpenMP region on several threads hangs in its first one. The parent
+# (which may build a missing index) stays on one thread; workers get the
+# configured count back.
+OMP_THREADS = faiss.omp_get_max_threads()
+faiss.omp_set_num_threads(1)
+
+import main  # loads the snapshot
+import metrics
+from utils import MODEL_NAME, get_model
+
+main.SNAPSHOT_WATCH = False
+
+# Same for torch: the parent only loads the encoder, on one thread, and
+# workers get the configured count back. Their lifespan warm-up then just runs
+# one encode on the inherited model.
+TORCH_THREADS = None
+if main.SEARCH_WARM_ENCODER:
+    try:
+        import torch
+        TORCH_THREADS = torch.get_num_threads()
+        torch.set_num_threads(1)
+        get_model(MODEL_NAME)
+    except Exception as e:
+        print("[serve] Query encoder failed to load:", e)
+# Resolved once here (protocol and loop imports) rather than in every worker
+CONFIG = uvicorn.Config(main.app, lifespan="on")
+CONFIG.load()
+
+
+class WorkerServer(uvicorn.Server):
+    def __init__(self, config: uvicorn.Config, forked_at: float):
+        super().__init__(config)
+        self.forked_at = forked_at
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        print(f"[serve] Worker {os.getpid()} ready in {time.perf_counter() - self.forked_at:.2f}s")
+
+
+def run_worker(sock: socket.socket, forked_at: float):
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sig, signal.SIG_DFL)
+    faiss.omp_set_num_threads(OMP_THREADS)
+    if TORCH_THREADS:
+        torch.set_num_threads(TORCH_THREADS)
+    # uvicorn installs its own SIGTERM / SIGINT handling (graceful shutdown)
+    WorkerServer(CONFIG, forked_at).run(sockets=[sock])
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Supervisor:
+    def __init__(self, sock: socket.socket, workers: int):
+        self.sock = sock
+        self.workers = workers
+        self.pids = set()
+        self.retiring = {}  # pid -> SIGTERM time
+        self.stopping = False
+        self.restart = False
+
+    def spawn(self):
+        forked_at = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.sock, forked_at)
+            except BaseException as e:
+                print(f"[serve] Worker {os.getpid()} failed:", e)
+                code = 1
+            finally:
+                os._exit(code)
+        self.pids.add(pid)
+
+    def freeze(self):
+        # Moves everything loaded so far out of the GC's generations, so
+        # collections in the workers do not write to (and copy) shared pages
+        gc.collect()
+        gc.freeze()
+
+    def replace_workers(self):
+        """Fork a fresh set from the current state, then retire the old one;
+        old workers finish their requests while the new ones accept."""
+        old = list(self.pids)
+        self.freeze()
+        for pid in old:
+            self.pids.discard(pid)
+            self.spawn()
+            self.retire(pid)
+
+    def retire(self, pid: int):
+        try:
+            os.kill(pid, signal.SIGTERM)
+            self.retiring[pid] = time.monotonic()
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            # A worker that crashed never folded its metrics into the totals
+            metrics.fold_exited(pid)
+            if self.retiring.pop(pid, None) is None and pid in self.pids:
+                self.pids.discard(pid)
+                print(f"[serve] Worker {pid} exited (status {status})")
+
+    def kill_stragglers(self, force: bool = False):
+        now = time.monotonic()
+        for pid, since in list(self.retiring.items()):
+            if force or now - since > GRACEFUL_TIMEOUT:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def check_snapshot(self):
+        if main.current_version(main.ARTIFACTS_DIR) == main.SNAPSHOT.version:
+            return
+        # Lets the outgoing snapshot be collected; frozen again before forking
+        gc.unfreeze()
+        try:
+            main.reload_snapshot_if_changed()
+        except Exception as e:
+            print("[serve] Snapshot reload failed:", e)
+            self.freeze()
+            return
+        self.replace_workers()
+
+    def run(self):
+        def stop(*_):
+            self.stopping = True
+
+        def hup(*_):
+            self.restart = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, hup)
+
+        self.freeze()
+        for _ in range(self.workers):
+            self.spawn()
+        next_poll = time.monotonic() + main.SNAPSHOT_POLL_SECONDS
+        while not self.stopping:
+            time.sleep(0.5)
+            self.reap()
+            self.kill_stragglers()
+            if self.stopping:
+                break
+            # Crashed workers come back one per tick, so a crash loop is slowed
+            if len(self.pids) < self.workers:
+                self.spawn()
+            if self.restart:
+                self.restart = False
+                self.replace_workers()
+            if time.monotonic() >= next_poll:
+                self.check_snapshot()
+                next_poll = time.monotonic() + main.SNAPSHOT_POLL_SECONDS
+
+        for pid in self.pids:
+            self.retire(pid)
+        self.pids.clear()
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        while self.retiring and time.monotonic() < deadline:
+            time.sleep(0.1)
+            self.reap()
+        self.kill_stragglers(force=True)
+
+
+if __name__ == "__main__":
+    sock = bind_socket(HOST, PORT)
+    print(f"[serve] Startup: {time.perf_counter() - _STARTED:.2f}s to load; forking {WORKERS} workers on {HOST}:{PORT}")
+    Supervisor(sock, WORKERS).run()
@@ -0,0 +1,93 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import numpy as np
+import httpx
+import msgpack
+from dotenv import load_dotenv
+
+from metrics import Counter
+
+load_dotenv()
+
+# Shard servers of a sharded build, one URL per shard (comma-separated). When
+# set, searches fan out to them instead of running on a local index.
+SHARD_URLS = [url.strip().rstrip("/") for url in os.getenv("SHARD_URLS", "").split(",") if url.strip()]
+SHARD_TIMEOUT = float(os.getenv("SHARD_TIMEOUT", "2"))
+
+SHARD_REQUESTS = Counter(
+    "recommender_shard_requests_total", "Shard searches by shard and outcome.", ["shard", "outcome"])
+
+# Created on first use, so a process forked before that gets its own
+_client: Optional[httpx.Client] = None
+_pool: Optional[ThreadPoolExecutor] = None
+_client_lock = threading.Lock()
+
+
+def sharded() -> bool:
+    return bool(SHARD_URLS)
+
+
+def _session():
+    global _client, _pool
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(
+                timeout=httpx.Timeout(SHARD_TIMEOUT),
+                limits=httpx.Limits(max_connections=16 * len(SHARD_URLS), max_keepalive_connections=4 * len(SHARD_URLS)),
+            )
+            _pool = ThreadPoolExecutor(max_workers=4 * len(SHARD_URLS), thread_name_prefix="shard")
+        return _client, _pool
+
+
+def _search_one(client: httpx.Client, url: str, body: bytes) -> dict:
+    resp = client.post(f"{url}/search", content=body, headers={"Content-Type": "application/msgpack"})
+    resp.raise_for_status()
+    return msgpack.unpackb(resp.content)
+
+
+def search_shards(queries: np.ndarray, k: int, version: str,
+                  filter_category: Optional[str] = None,
+                  min_price: Optional[float] = None,
+                  max_price: Optional[float] = None,
+                  nprobe: Optional[int] = None,
+                  ef_search: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, bool]:
+    """
+    Top-k (scores, index ids, complete) for L2-normalized `queries` across
+    all shards: every shard returns its own filtered top-k and the union is
+    merged by score. Shards that fail or answer for another build version are
+    left out (results degrade instead of failing) and `complete` is False;
+    raises if none answered.
+    """
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    body = msgpack.packb({
+        "queries": queries.tobytes(), "d": int(queries.shape[1]), "k": int(k), "version": version,
+        "filter_category": filter_category, "min_price": min_price, "max_price": max_price,
+        "nprobe": nprobe, "ef_search": ef_search,
+    })
+    client, pool = _session()
+    futures = [(url, pool.submit(_search_one, client, url, body)) for url in SHARD_URLS]
+
+    scores, ids = [], []
+    for shard, (url, future) in enumerate(futures):
+        try:
+            part = future.result()
+        except Exception as e:
+            print(f"Shard {url} search error:", e)
+            SHARD_REQUESTS.inc(shard=shard, outcome="error")
+            continue
+        if part["version"] != version:
+            SHARD_REQUESTS.inc(shard=shard, outcome="version_mismatch")
+            continue
+        SHARD_REQUESTS.inc(shard=shard, outcome="ok")
+        scores.append(np.frombuffer(part["scores"], dtype="float32").reshape(len(queries), part["k"]))
+        ids.append(np.frombuffer(part["ids"], dtype="int64").reshape(len(queries), part["k"]))
+    if not scores:
+        raise RuntimeError("No index shard answered")
+
+    D = np.concatenate(scores, axis=1)
+    I = np.concatenate(ids, axis=1)
+    top = np.argsort(-D, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(D, top, axis=1), np.take_along_axis(I, top, axis=1), len(scores) == len(SHARD_URLS)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+One shard of a sharded build (INDEX_SHARDS > 1 in build_embeddings): serves
+top-k searches over shard-<SHARD_ID> of the current version. The front end
+(main.py with SHARD_URLS) fans every search out to all shards and merges.
+
+    SHARD_ID=0 PORT=8101 python shard_server.py
+    SHARD_ID=1 PORT=8102 python shard_server.py
+
+Shards read the same ARTIFACTS_DIR as the front end (a shared volume when
+they run on other nodes) and swap to a newly published build on their own.
+"""
+import os
+import json
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import faiss
+import msgpack
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request, Response
+from starlette.concurrency import run_in_threadpool
+from dotenv import load_dotenv
+
+from model_snapshot import ARTIFACTS_DIR, LEGACY_VERSION, artifact_paths, catalog_mask, current_version, shard_paths
+from vector_index import configure_blas, read_index, search_params
+
+load_dotenv()
+
+SHARD_ID = int(os.getenv("SHARD_ID", "0"))
+SNAPSHOT_POLL_SECONDS = float(os.getenv("SNAPSHOT_POLL_SECONDS", "5"))
+
+
+@dataclass(frozen=True)
+class Shard:
+    """One build's index for this shard plus, per shard row, the global
+    index id and the catalog columns filters run on."""
+    version: str
+    index: object
+    ids: np.ndarray
+    in_lookup: np.ndarray
+    prices: np.ndarray
+    category_codes: np.ndarray
+    category_vocab: dict
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+
+def load_shard(artifacts_dir: str = ARTIFACTS_DIR, shard_id: int = SHARD_ID) -> Optional[Shard]:
+    version = current_version(artifacts_dir)
+    paths = artifact_paths(None if version == LEGACY_VERSION else os.path.join(artifacts_dir, version))
+    sp = shard_paths(paths["shards"], shard_id)
+    if not os.path.exists(sp["manifest"]) or not os.path.exists(sp["columns"]):
+        print(f"[shard {shard_id}] No shard artifacts for version {version}")
+        return None
+    with open(sp["manifest"], "r") as f:
+        manifest = json.load(f)
+    if shard_id >= manifest["shards"]:
+        print(f"[shard {shard_id}] Version {version} only has {manifest['shards']} shards")
+        return None
+
+    with np.load(sp["columns"], allow_pickle=False) as columns:
+        cols = {name: columns[name] for name in columns.files}
+    index = read_index(sp["faiss_index"]) if os.path.exists(sp["faiss_index"]) else None
+    if index is not None:
+        configure_blas(index.d)
+    print(f"[shard {shard_id}] Serving version {version}: {len(cols['ids'])} rows")
+    return Shard(
+        version=version,
+        index=index,
+        ids=cols["ids"],
+        in_lookup=cols["in_lookup"],
+        prices=cols["prices"],
+        category_codes=cols["category_codes"],
+        category_vocab={str(name): i for i, name in enumerate(cols["categories"])},
+    )
+
+
+SHARD: Optional[Shard] = load_shard()
+
+
+def reload_shard_if_changed():
+    global SHARD
+    version = current_version(ARTIFACTS_DIR)
+    if SHARD is None or version != SHARD.version:
+        shard = load_shard()
+        if shard is not None:
+            SHARD = shard
+
+
+async def watch_shard_version():
+    while True:
+        await asyncio.sleep(SNAPSHOT_POLL_SECONDS)
+        try:
+            await run_in_threadpool(reload_shard_if_changed)
+        except Exception as e:
+            print(f"[shard {SHARD_ID}] Reload failed:", e)
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    watcher = asyncio.create_task(watch_shard_version())
+    try:
+        yield
+    finally:
+        watcher.cancel()
+
+
+app = FastAPI(title=f"ShopSense Recommender shard {SHARD_ID}", lifespan=lifespan)
+
+
+def search_shard(shard: Shard, queries: np.ndarray, k: int,
+                 filter_category: Optional[str] = None,
+                 min_price: Optional[float] = None,
+                 max_price: Optional[float] = None,
+                 nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Top-k (scores, global index ids) among this shard's rows that pass the
+    filters; rows past the shard's eligible count are padded with -inf / -1."""
+    n = len(queries)
+    allowed = None
+    if filter_category or min_price is not None or max_price is not None:
+        allowed = catalog_mask(shard.in_lookup, shard.prices, shard.category_codes, shard.category_vocab,
+                               filter_category, min_price, max_price)
+    n_allowed = shard.size if allowed is None else int(allowed.sum())
+    k = min(k, n_allowed)
+    if shard.index is None or k == 0:
+        return np.full((n, 0), -np.inf, dtype="float32"), np.full((n, 0), -1, dtype="int64")
+
+    sel = None
+    if allowed is not None:
+        bitmap = np.packbits(allowed, bitorder="little")
+        sel = faiss.IDSelectorBitmap(len(allowed), faiss.swig_ptr(bitmap))
+    D, I = shard.index.search(queries, k, params=search_params(shard.index, nprobe, ef_search, sel=sel))
+    return D, np.where(I >= 0, shard.ids[np.maximum(I, 0)], -1)
+
+
+@app.post("/search")
+async def search(request: Request):
+    """
+    msgpack body: {"queries": float32 bytes, "d", "k", "version",
+    "filter_category", "min_price", "max_price", "nprobe", "ef_search"};
+    queries are L2-normalized by the front end. Answers msgpack
+    {"version", "k", "scores": float32 bytes, "ids": int64 bytes}.
+    """
+    body = msgpack.unpackb(await request.body())
+    if SHARD is None or SHARD.version != body.get("version"):
+        # The front end may have swapped to a new build first
+        await run_in_threadpool(reload_shard_if_changed)
+    shard = SHARD
+    if shard is None:
+        raise HTTPException(status_code=503, detail="Shard not loaded")
+
+    queries = np.frombuffer(body["queries"], dtype="float32").reshape(-1, body["d"])
+    D, ids = await run_in_threadpool(
+        search_shard, shard, queries, int(body["k"]),
+        body.get("filter_category"), body.get("min_price"), body.get("max_price"),
+        body.get("nprobe"), body.get("ef_search"),
+    )
+    payload = {
+        "version": shard.version,
+        "k": int(D.shape[1]),
+        "scores": np.ascontiguousarray(D, dtype="float32").tobytes(),
+        "ids": np.ascontiguousarray(ids, dtype="int64").tobytes(),
+    }
+    return Response(msgpack.packb(payload), media_type="application/msgpack")
+
+
+@app.get("/health")
+def health():
+    shard = SHARD
+    return {
+        "status": "ok" if shard is not None else "not_loaded",
+        "shard": SHARD_ID,
+        "model_version": shard.version if shard is not None else None,
+        "rows": shard.size if shard is not None else 0,
+    }
+
+
+if __name__ == "__main__":
+    port = int(os.getenv("PORT", str(8100 + SHARD_ID)))
+    # The app object, not "shard_server:app": an import string would load the
+    # module (and the shard) a second time
+    uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,182 @@
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+from redis import WatchError
+from dotenv import load_dotenv
+
+from redis_client import redis_binary
+
+load_dotenv()
+
+# Per-user running profile, updated on every event (POST /profile/event)
+PROFILE_KEY = "user_profile:{user_id}"
+PROFILE_HALF_LIFE = float(os.getenv("PROFILE_HALF_LIFE", "259200"))   # seconds (3 days)
+PROFILE_TTL = int(os.getenv("PROFILE_TTL", "2592000"))                # 30 days
+# Cosine distance from the profile at the last generation bump that starts a
+# new generation (and so a new recommend cache entry)
+PROFILE_DRIFT = float(os.getenv("PROFILE_DRIFT", "0.02"))
+UPDATE_RETRIES = 5
+CATEGORY_PREFIX = b"c:"
+# Marks a seeded event until its own update arrives (see update_profile)
+SEEDED_PREFIX = "e:"
+
+
+def _unit(vec: np.ndarray) -> np.ndarray:
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm > 0 else vec
+
+
+def _parse(raw: dict) -> Optional[dict]:
+    if not raw or b"vec" not in raw:
+        return None
+    return {
+        "sum": np.frombuffer(raw[b"vec"], dtype="float32"),
+        "weight": float(raw.get(b"w", 0)),
+        "ts": float(raw.get(b"ts", 0)),
+        "gen": int(raw.get(b"gen", 0)),
+        "version": raw.get(b"ver", b"").decode("utf-8"),
+        "ref": np.frombuffer(raw[b"ref"], dtype="float32") if b"ref" in raw else None,
+        "categories": {
+            k[len(CATEGORY_PREFIX):].decode("utf-8"): int(v)
+            for k, v in raw.items() if k.startswith(CATEGORY_PREFIX)
+        },
+    }
+
+
+def seeded_field(product_id: str, event_type: str, ts: float) -> str:
+    """Hash field marking an event as already folded in by a seed (millisecond
+    timestamps, as the Node backend stores them)."""
+    return f"{SEEDED_PREFIX}{round(ts * 1000)}:{event_type}:{product_id}"
+
+
+def update_profile(user_id: str, item_vec: np.ndarray, weight: float, version: str,
+                   category: Optional[str] = None, ts: Optional[float] = None,
+                   event: Optional[str] = None, seed: Optional[dict] = None) -> Tuple[int, int]:
+    """
+    Fold one event into the user's profile: the stored weighted sum and total
+    weight decay with PROFILE_HALF_LIFE, then the item vector is added with
+    the event weight. Returns the profile generation, which only changes when
+    the profile direction drifted more than PROFILE_DRIFT since the last bump,
+    and how many seed events were written.
+
+    A profile that does not exist yet, or was built against another snapshot
+    `version`, is replaced by `seed` (see profile_seed) plus this event in the
+    same transaction. Each seeded event is marked in the profile, so when its
+    own update arrives (`event`, see seeded_field) it is not folded twice.
+    """
+    key = PROFILE_KEY.format(user_id=user_id)
+    item_vec = np.asarray(item_vec, dtype="float32").ravel()
+    ts = time.time() if ts is None else float(ts)
+
+    for _ in range(UPDATE_RETRIES):
+        with redis_binary.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                raw = pipe.hgetall(key)
+                prof = _parse(raw)
+                fresh = prof is None or prof["version"] != version or len(prof["sum"]) != len(item_vec)
+                if not fresh and event and event.encode("utf-8") in raw:
+                    # Already in the seed this profile started from
+                    pipe.multi()
+                    pipe.hdel(key, event)
+                    pipe.execute()
+                    return prof["gen"], 0
+                seeded = 0
+                if fresh:
+                    # New user, or a profile from another build
+                    prof = {"sum": np.zeros_like(item_vec), "weight": 0.0, "ts": ts, "gen": 0, "ref": None}
+                    if seed is not None and len(seed["sum"]) == len(item_vec):
+                        prof = {**prof, **seed, "gen": 1}
+                        seeded = len(seed["events"])
+
+                # Decay whichever side is older (events may arrive out of order)
+                age = (ts - prof["ts"]) / PROFILE_HALF_LIFE
+                old_decay, new_decay = (0.5 ** age, 1.0) if age >= 0 else (1.0, 0.5 ** -age)
+                total = prof["sum"] * old_decay + item_vec * (weight * new_decay)
+                total_weight = prof["weight"] * old_decay + weight * new_decay
+
+                unit = _unit(total)
+                gen, ref = prof["gen"], prof["ref"]
+                if ref is None or 1.0 - float(unit @ ref) > PROFILE_DRIFT:
+                    gen, ref = gen + 1, unit
+
+                pipe.multi()
+                if fresh:
+                    pipe.delete(key)
+                pipe.hset(key, mapping={
+                    "vec": total.astype("float32").tobytes(),
+                    "w": repr(total_weight),
+                    "ts": repr(max(ts, prof["ts"])),
+                    "gen": gen,
+                    "ref": ref.astype("float32").tobytes(),
+                    "ver": version,
+                })
+                if seeded:
+                    pipe.hset(key, mapping={field: 1 for field in seed["events"]})
+                    for seed_category in seed["categories"]:
+                        pipe.hincrby(key, CATEGORY_PREFIX.decode() + seed_category, 1)
+                if category:
+                    pipe.hincrby(key, CATEGORY_PREFIX.decode() + category, 1)
+                pipe.expire(key, PROFILE_TTL)
+                pipe.execute()
+                return gen, seeded
+            except WatchError:
+                continue
+    raise RuntimeError(f"Profile update for {user_id} kept conflicting")
+
+
+def profile_seed(item_vecs: np.ndarray, weights: List[float], ts: List[float],
+                 categories: List[Optional[str]], events: List[str]) -> dict:
+    """
+    A starting profile from the user's event history (one row of `item_vecs`
+    per event, `events` their seeded_field names), decayed to the newest
+    event as update_profile would have folded them. Written by update_profile
+    only when the user has no profile for the serving snapshot.
+    """
+    item_vecs = np.asarray(item_vecs, dtype="float32").reshape(len(weights), -1)
+    newest = max(ts)
+    decayed = np.asarray(weights, dtype="float64") * 0.5 ** ((newest - np.asarray(ts, dtype="float64")) / PROFILE_HALF_LIFE)
+    total = (decayed.astype("float32") @ item_vecs).astype("float32")
+    return {
+        "sum": total,
+        "weight": float(decayed.sum()),
+        "ts": newest,
+        "ref": _unit(total).astype("float32"),
+        "categories": [category for category in categories if category],
+        "events": events,
+    }
+
+
+def _as_profile(prof: Optional[dict]) -> Optional[dict]:
+    if prof is None or prof["weight"] <= 0:
+        return None
+    return {
+        "vector": _unit(prof["sum"] / prof["weight"]).astype("float32").reshape(1, -1),
+        "gen": prof["gen"],
+        "version": prof["version"],
+        "categories": prof["categories"],
+    }
+
+
+def read_profile(user_id: str) -> Optional[dict]:
+    """The user's normalized profile vector (1, d), generation, snapshot version
+    and category counts, or None when there is no profile (or Redis is unavailable)."""
+    try:
+        return _as_profile(_parse(redis_binary.hgetall(PROFILE_KEY.format(user_id=user_id))))
+    except Exception as e:
+        print("Redis profile read error:", e)
+        return None
+
+
+def read_profiles(user_ids: List[str]) -> List[Optional[dict]]:
+    """read_profile for several users in one pipelined round-trip."""
+    try:
+        with redis_binary.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.hgetall(PROFILE_KEY.format(user_id=user_id))
+            return [_as_profile(_parse(raw)) for raw in pipe.execute()]
+    except Exception as e:
+        print("Redis profile read error:", e)
+        return [None] * len(user_ids)
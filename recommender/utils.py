@@ -1,8 +1,8 @@
 import os
 import json
+import threading
 import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,26 +12,149 @@ EMBEDDINGS_PATH = os.getenv("EMBEDDINGS_PATH", "./embeddings.npy")
 FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "./faiss_index.bin")
 PRODUCT_IDS_PATH = os.getenv("PRODUCT_IDS_PATH", "./product_ids.json")
 PRODUCTS_CSV = os.getenv("PRODUCTS_CSV", "../data/products_curated_v3_with_brands.csv")
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", "./catalog.pkl")
 TOP_K = int(os.getenv("TOP_K", "10"))
 
+# Encoding throughput knobs for build_embeddings
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_PROCESSES = int(os.getenv("EMBED_PROCESSES", "1"))    # 0 = one per CPU core
+EMBED_CHUNK_SIZE = int(os.getenv("EMBED_CHUNK_SIZE", "20000"))
+
+# Storage type of the served embeddings; float16 / int8 halve / quarter worker memory
+EMBEDDINGS_DTYPE = os.getenv("EMBEDDINGS_DTYPE", "float32")
+EMBEDDINGS_DTYPES = ("float32", "float16", "int8")
+
+_models = {}
+_models_lock = threading.Lock()
+
 def load_products(csv_path=PRODUCTS_CSV):
     df = pd.read_csv(csv_path)
     # ensure product_id column exists and is string
     df['product_id'] = df['product_id'].astype(str)
     return df
 
-def compute_embeddings(texts, model_name=MODEL_NAME):
-    model = SentenceTransformer(model_name)
-    embeddings = model.encode(texts, show_progress_bar=True, convert_to_numpy=True)
-    return embeddings
+def save_catalog_snapshot(df, snapshot_path=CATALOG_SNAPSHOT_PATH):
+    # Columnar binary copy of the parsed catalog; avoids re-parsing the CSV at startup
+    df.to_pickle(snapshot_path)
 
-def save_embeddings(embeddings, product_ids, embeddings_path=EMBEDDINGS_PATH, ids_path=PRODUCT_IDS_PATH):
-    np.save(embeddings_path, embeddings)
-    with open(ids_path, "w") as f:
+def load_catalog(csv_path=PRODUCTS_CSV, snapshot_path=CATALOG_SNAPSHOT_PATH):
+    """Load the catalog from the snapshot when it is at least as new as the CSV."""
+    if os.path.exists(snapshot_path) and (
+        not os.path.exists(csv_path)
+        or os.path.getmtime(snapshot_path) >= os.path.getmtime(csv_path)
+    ):
+        return pd.read_pickle(snapshot_path)
+    return load_products(csv_path)
+
+def get_model(model_name=MODEL_NAME):
+    """Process-wide SentenceTransformer, loaded once per model name."""
+    with _models_lock:
+        if model_name not in _models:
+            # Imported on first use: torch adds seconds to the startup of
+            # processes that never encode text
+            from sentence_transformers import SentenceTransformer
+            _models[model_name] = SentenceTransformer(model_name)
+        return _models[model_name]
+
+def compute_embeddings(texts, model_name=MODEL_NAME, batch_size=EMBED_BATCH_SIZE,
+                       processes=EMBED_PROCESSES, chunk_size=EMBED_CHUNK_SIZE, out_path=None):
+    """
+    Encode `texts` into a float32 (len(texts), d) array, in input order.
+
+    Texts are encoded shortest-first in chunks of `chunk_size`, so every batch
+    holds texts of similar length (little padding) and only one chunk of
+    vectors is in memory at a time. With `out_path`, chunks are streamed into
+    a .npy memmap at that path, which is returned. `processes` > 1 (0 = all
+    cores) spreads each chunk over a sentence-transformers worker pool.
+    """
+    model = get_model(model_name)
+    n = len(texts)
+    d = model.get_sentence_embedding_dimension()
+    if out_path is not None:
+        out = np.lib.format.open_memmap(out_path, mode="w+", dtype="float32", shape=(n, d))
+    else:
+        out = np.empty((n, d), dtype="float32")
+    if n == 0:
+        return out
+
+    order = np.argsort([len(t) for t in texts], kind="stable")
+    processes = processes or os.cpu_count() or 1
+    # A worker pool loads one model copy per process; only worth it for real batches
+    use_pool = processes > 1 and n > batch_size * processes
+    pool = model.start_multi_process_pool(["cpu"] * processes) if use_pool else None
+    try:
+        for start in range(0, n, chunk_size):
+            rows = order[start:start + chunk_size]
+            chunk = [texts[i] for i in rows]
+            if pool is not None:
+                vectors = model.encode_multi_process(chunk, pool, batch_size=batch_size)
+            else:
+                vectors = model.encode(chunk, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True)
+            out[rows] = vectors
+            print(f"Encoded {min(start + chunk_size, n)}/{n}")
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+
+    if out_path is not None:
+        out.flush()
+    return out
+
+def save_product_ids(product_ids, ids_path=PRODUCT_IDS_PATH):
+    tmp = f"{ids_path}.tmp"
+    with open(tmp, "w") as f:
         json.dump(product_ids, f)
+    os.replace(tmp, ids_path)
+
+def save_embeddings(embeddings, product_ids, embeddings_path=EMBEDDINGS_PATH, ids_path=PRODUCT_IDS_PATH):
+    tmp = f"{embeddings_path}.tmp.npy"
+    np.save(tmp, embeddings)
+    # Write-then-rename: workers that memory-mapped the old file keep a valid mapping
+    os.replace(tmp, embeddings_path)
+    save_product_ids(product_ids, ids_path)
+
+def int8_scale(embeddings, chunk_size=EMBED_CHUNK_SIZE):
+    """Per-dimension symmetric scale mapping max |x| to 127."""
+    peak = np.zeros(embeddings.shape[1], dtype="float32")
+    for start in range(0, len(embeddings), chunk_size):
+        np.maximum(peak, np.abs(embeddings[start:start + chunk_size]).max(axis=0), out=peak)
+    return np.maximum(peak, 1e-12) / 127.0
+
+def quantize(block, dtype, scale=None):
+    if dtype == "int8":
+        return np.clip(np.rint(block / scale), -127, 127).astype("int8")
+    return block.astype(dtype)
+
+def dequantize(block, scale=None):
+    """float32 copy of stored embedding rows (int8 rows are multiplied by `scale`)."""
+    block = np.array(block, dtype="float32")
+    if scale is not None:
+        block *= scale
+    return block
+
+def save_quantized_embeddings(embeddings, dtype, out_path, scale_path, chunk_size=EMBED_CHUNK_SIZE):
+    """
+    Write float32 `embeddings` as `dtype` to `out_path` chunk by chunk; int8
+    also writes its per-dimension scale to `scale_path`. Returns the scale
+    (None for float16).
+    """
+    if dtype not in EMBEDDINGS_DTYPES[1:]:
+        raise ValueError(f"Unknown EMBEDDINGS_DTYPE '{dtype}', expected one of {EMBEDDINGS_DTYPES}")
+    scale = int8_scale(embeddings, chunk_size) if dtype == "int8" else None
+    tmp = f"{out_path}.tmp.npy"
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=embeddings.shape)
+    for start in range(0, len(embeddings), chunk_size):
+        out[start:start + chunk_size] = quantize(embeddings[start:start + chunk_size], dtype, scale)
+    out.flush()
+    del out
+    os.replace(tmp, out_path)
+    if scale is not None:
+        np.save(scale_path, scale)
+    return scale
 
-def load_embeddings(embeddings_path=EMBEDDINGS_PATH, ids_path=PRODUCT_IDS_PATH):
-    emb = np.load(embeddings_path)
+def load_embeddings(embeddings_path=EMBEDDINGS_PATH, ids_path=PRODUCT_IDS_PATH, mmap=False):
+    # mmap=True maps the .npy read-only instead of copying it into process memory
+    emb = np.load(embeddings_path, mmap_mode="r" if mmap else None)
     with open(ids_path, "r") as f:
         ids = json.load(f)
     return emb, ids
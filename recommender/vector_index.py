@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import zlib
+import numpy as np
+import faiss
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Index type: flat (exact), ivf_flat, ivf_pq, hnsw, or sq8 / sqfp16 (flat scan
+# over int8 / float16 scalar-quantized codes, 4x / 2x smaller than flat)
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")
+
+# Build-time parameters
+IVF_NLIST = int(os.getenv("IVF_NLIST", "0"))            # 0 = ~4*sqrt(N)
+IVF_TRAIN_SAMPLE = int(os.getenv("IVF_TRAIN_SAMPLE", "200000"))
+PQ_M = int(os.getenv("PQ_M", "16"))                      # sub-quantizers (must divide d)
+PQ_NBITS = int(os.getenv("PQ_NBITS", "8"))
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+
+# Search-time defaults (overridable per request)
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+
+INDEX_REPORT_PATH = os.getenv("INDEX_REPORT_PATH", "./index_report.json")
+
+# Memory-map the index file read-only so workers share the page cache
+FAISS_MMAP = os.getenv("FAISS_MMAP", "1") == "1"
+
+# Item-to-item table: neighbours stored per product (0 = skip), queries per search call
+NEIGHBORS_N = int(os.getenv("NEIGHBORS_N", "20"))
+NEIGHBORS_BATCH = int(os.getenv("NEIGHBORS_BATCH", "4096"))
+
+# Exact (flat) searches of at least this many queries run as one BLAS matrix
+# product instead of a per-query scan, so micro-batched searches share one
+# pass over the vectors; 0 keeps the faiss default (recent faiss compares its
+# threshold with queries x dimension, i.e. ~330 queries at d=384)
+FAISS_BLAS_MIN_BATCH = int(os.getenv("FAISS_BLAS_MIN_BATCH", "4"))
+
+# Sharded serving: build_embeddings also writes this many per-shard indexes
+# (each served by shard_server.py); 0 or 1 = a single index only
+INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", "0"))
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "sq8", "sqfp16")
+
+
+def _nlist_for(n: int) -> int:
+    nlist = IVF_NLIST or int(4 * np.sqrt(max(n, 1)))
+    # FAISS wants ~39 training points per centroid
+    return max(1, min(nlist, n // 39 or 1))
+
+
+def _pq_m_for(d: int) -> int:
+    m = min(PQ_M, d)
+    while d % m:
+        m -= 1
+    return m
+
+
+def _pq_nbits_for(n: int) -> int:
+    # Each PQ codebook needs ~39 training points per centroid
+    nbits = PQ_NBITS
+    while nbits > 4 and n < 39 * (1 << nbits):
+        nbits -= 1
+    return nbits
+
+
+def index_factory_string(index_type: str, n: int, d: int, with_ids: bool = False) -> str:
+    # IVF indexes store explicit ids natively; the others need an IDMap2 wrapper
+    idmap = "IDMap2," if with_ids else ""
+    if index_type == "flat":
+        return f"{idmap}Flat"
+    if index_type == "ivf_flat":
+        return f"IVF{_nlist_for(n)},Flat"
+    if index_type == "ivf_pq":
+        return f"IVF{_nlist_for(n)},PQ{_pq_m_for(d)}x{_pq_nbits_for(n)}"
+    if index_type == "hnsw":
+        return f"{idmap}HNSW{HNSW_M},Flat"
+    if index_type == "sq8":
+        return f"{idmap}SQ8"
+    if index_type == "sqfp16":
+        return f"{idmap}SQfp16"
+    raise ValueError(f"Unknown INDEX_TYPE '{index_type}', expected one of {INDEX_TYPES}")
+
+
+def shard_assignment(product_ids, n_shards: int) -> np.ndarray:
+    """Shard of every product, by a stable hash of its id, so a product stays
+    on the same shard across builds."""
+    return np.fromiter((zlib.crc32(str(pid).encode("utf-8")) % n_shards for pid in product_ids),
+                       dtype="int32", count=len(product_ids))
+
+
+def base_index(index):
+    """The index doing the actual search, unwrapping an IDMap if present."""
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def supports_remove(index) -> bool:
+    return not isinstance(base_index(index), faiss.IndexHNSW)
+
+
+def create_index(vectors: np.ndarray, index_type: str = INDEX_TYPE, ids: np.ndarray = None):
+    """
+    Build an inner-product index over L2-normalized `vectors` (float32).
+    IVF variants are trained on a random sample of at most IVF_TRAIN_SAMPLE rows.
+    With `ids`, vectors are stored under those int64 ids so the index can later
+    be updated in place (add_with_ids / remove_ids).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n, d = vectors.shape
+    factory = index_factory_string(index_type, n, d, with_ids=ids is not None)
+    index = faiss.index_factory(d, factory, faiss.METRIC_INNER_PRODUCT)
+
+    if isinstance(base_index(index), faiss.IndexHNSW):
+        base_index(index).hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+
+    if not index.is_trained:
+        if n > IVF_TRAIN_SAMPLE:
+            sample = np.random.default_rng(0).choice(n, IVF_TRAIN_SAMPLE, replace=False)
+            index.train(vectors[np.sort(sample)])
+        else:
+            index.train(vectors)
+
+    if ids is None:
+        index.add(vectors)
+    else:
+        index.add_with_ids(vectors, np.ascontiguousarray(ids, dtype="int64"))
+    return index
+
+
+def read_index(path: str, mmap: bool = FAISS_MMAP):
+    if not mmap:
+        return faiss.read_index(path)
+    # IO_FLAG_MMAP_IFC also maps flat code storage (faiss >= 1.8)
+    flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    return faiss.read_index(path, flag | faiss.IO_FLAG_READ_ONLY)
+
+
+def configure_blas(d: int, min_batch: int = FAISS_BLAS_MIN_BATCH):
+    """Set faiss' (process-wide) BLAS threshold for `d`-dimensional queries."""
+    if min_batch > 0:
+        faiss.cvar.distance_compute_blas_threshold = min_batch * d
+
+
+def search_params(index, nprobe: int = None, ef_search: int = None, sel=None):
+    """SearchParameters matching the index type, carrying the ANN knobs and an
+    optional IDSelector. Returns None when nothing needs to be set."""
+    index = base_index(index)
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=sel, nprobe=nprobe or IVF_NPROBE)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=ef_search or HNSW_EF_SEARCH)
+    if sel is not None:
+        return faiss.SearchParameters(sel=sel)
+    return None
+
+
+def _timed_search(index, queries, k, params):
+    t0 = time.perf_counter()
+    D, I = index.search(queries, k, params=params)
+    return D, I, (time.perf_counter() - t0) * 1000.0 / len(queries)
+
+
+def recall_report(vectors: np.ndarray, index, k: int = 10, n_queries: int = 1000,
+                  nprobe: int = None, ef_search: int = None, ids: np.ndarray = None) -> dict:
+    """
+    Recall@k and per-query latency of `index` against an exact flat index over
+    the same vectors. Queries are catalog rows, so this measures how well the
+    ANN index reproduces "similar product" neighbourhoods. `ids` maps rows to
+    the ids stored in `index`, if it was built with explicit ids.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n, d = vectors.shape
+    k = min(k, n)
+    rows = np.random.default_rng(1).choice(n, min(n_queries, n), replace=False)
+    queries = vectors[np.sort(rows)]
+
+    exact = faiss.IndexFlatIP(d)
+    exact.add(vectors)
+    _, gt, flat_ms = _timed_search(exact, queries, k, None)
+    if ids is not None:
+        gt = np.asarray(ids)[gt]
+    _, got, ann_ms = _timed_search(index, queries, k, search_params(index, nprobe, ef_search))
+
+    hits = sum(len(set(g[g >= 0]) & set(t)) for g, t in zip(got, gt))
+    inner = base_index(index)
+    return {
+        "index": type(inner).__name__,
+        "n": int(n),
+        "d": int(d),
+        "k": int(k),
+        "queries": int(len(queries)),
+        "nprobe": (nprobe or IVF_NPROBE) if isinstance(inner, faiss.IndexIVF) else None,
+        "ef_search": (ef_search or HNSW_EF_SEARCH) if isinstance(inner, faiss.IndexHNSW) else None,
+        f"recall@{k}": hits / float(k * len(queries)),
+        "latency_ms_per_query": ann_ms,
+        "flat_latency_ms_per_query": flat_ms,
+    }
+
+
+def neighbor_table(index, vectors: np.ndarray, n: int = NEIGHBORS_N, ids: np.ndarray = None,
+                   batch_size: int = NEIGHBORS_BATCH):
+    """
+    Top-`n` most similar rows for every row of `vectors`, searched through
+    `index` in batches of `batch_size` queries. Returns (rows int32, scores
+    float16), both (N, n); the row itself is excluded and missing slots are
+    -1 / 0. `ids` maps rows to the ids stored in `index`, if explicit.
+    """
+    total = len(vectors)
+    n = min(n, max(total - 1, 0))
+    rows_out = np.full((total, n), -1, dtype="int32")
+    scores_out = np.zeros((total, n), dtype="float16")
+    if n == 0:
+        return rows_out, scores_out
+
+    if ids is not None:
+        order = np.argsort(ids, kind="stable")
+        sorted_ids = np.asarray(ids)[order]
+    params = search_params(index)
+    for start in range(0, total, batch_size):
+        queries = np.ascontiguousarray(vectors[start:start + batch_size], dtype="float32")
+        D, I = index.search(queries, n + 1, params=params)
+        if ids is not None:
+            pos = np.clip(np.searchsorted(sorted_ids, I), 0, len(sorted_ids) - 1)
+            I = np.where((I >= 0) & (sorted_ids[pos] == I), order[pos], -1)
+        own = np.arange(start, start + len(queries))[:, None]
+        # Push the query row itself and empty slots to the end, keep score order otherwise
+        drop = (I == own) | (I < 0)
+        keep = np.argsort(drop, axis=1, kind="stable")[:, :n]
+        I = np.take_along_axis(I, keep, axis=1)
+        D = np.take_along_axis(D, keep, axis=1)
+        valid = ~np.take_along_axis(drop, keep, axis=1)
+        rows_out[start:start + len(queries)] = np.where(valid, I, -1)
+        scores_out[start:start + len(queries)] = np.where(valid, D, 0)
+    return rows_out, scores_out
+
+
+def _chunked_topk(queries: np.ndarray, vectors: np.ndarray, k: int, scale=None, chunk_size: int = 50000):
+    """Exact inner-product top-k rows over `vectors`, scanned in chunks so a
+    memory-mapped or quantized matrix is never materialized as float32."""
+    best_s = np.full((len(queries), 0), -np.inf, dtype="float32")
+    best_i = np.zeros((len(queries), 0), dtype="int64")
+    for start in range(0, len(vectors), chunk_size):
+        block = np.asarray(vectors[start:start + chunk_size], dtype="float32")
+        if scale is not None:
+            block = block * scale
+        s = np.concatenate([best_s, queries @ block.T], axis=1)
+        i = np.concatenate([best_i, np.broadcast_to(np.arange(start, start + len(block)), (len(queries), len(block)))], axis=1)
+        keep = np.argsort(-s, axis=1, kind="stable")[:, :k]
+        best_s = np.take_along_axis(s, keep, axis=1)
+        best_i = np.take_along_axis(i, keep, axis=1)
+    return best_i
+
+
+def quantization_report(vectors: np.ndarray, stored: np.ndarray, scale=None, k: int = 10, n_queries: int = 1000) -> dict:
+    """
+    Top-k overlap of exact search over the stored (float16 / int8) embeddings
+    against the float32 `vectors` they were quantized from, for catalog-row
+    queries. Serving computes user vectors from the stored copy, so this is
+    the ranking change caused by quantization alone.
+    """
+    n, d = vectors.shape
+    k = min(k, n)
+    rows = np.sort(np.random.default_rng(2).choice(n, min(n_queries, n), replace=False))
+    queries = np.asarray(vectors[rows], dtype="float32")
+
+    exact = _chunked_topk(queries, vectors, k)
+    got = _chunked_topk(queries, stored, k, scale)
+    hits = sum(len(set(g) & set(t)) for g, t in zip(got, exact))
+    return {
+        "dtype": str(stored.dtype),
+        "k": int(k),
+        "queries": int(len(queries)),
+        f"overlap@{k}": hits / float(k * len(queries)),
+        "bytes_per_vector": int(stored.dtype.itemsize * d),
+        "float32_bytes_per_vector": int(4 * d),
+    }
+
+
+def write_report(report: dict, path: str = INDEX_REPORT_PATH):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)